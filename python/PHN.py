@@ -2,6 +2,40 @@
 import re
 import numpy
 
+def alignSegments(xmin, xmax, beg, end):
+	"""Vectorized version of getCode over many windows at once.
+
+	Returns the index of the segment chosen for each window (beg[i],end[i]) or -1 if none is. 
+	Both xmin and xmax have to be sorted, so the candidates for each window can be found by
+	bisection. The candidates are then checked in order using the same overlap rule as getCode.
+	"""
+	ret = numpy.empty(beg.size, dtype=int)
+	ret.fill(-1)
+	
+	lo = numpy.searchsorted(xmax, beg, side='left')
+	hi = numpy.searchsorted(xmin, end, side='right')
+	
+	todo = numpy.arange(beg.size)
+	k = 0
+	while todo.size > 0:
+		s = lo[todo] + k
+		v = s < hi[todo]
+		todo = todo[v]
+		s = s[v]
+		
+		b = beg[todo]
+		e = end[todo]
+		x0 = xmin[s]
+		x1 = xmax[s]
+		
+		m = ((e <= x1) & (b >= x0)) | ((b <= x0) & (e - x0 >= x0 - b)) | ((e >= x1) & (x1 - b >= e - x1))
+		
+		ret[todo[m]] = s[m]
+		todo = todo[~m]
+		k += 1
+		
+	return ret
+
 class Segment:
 	def __init__(self, xmin=0, xmax=0, text=''):
 		self.__dict__.update(locals())
@@ -57,26 +91,32 @@ class PHN:
 		text = str(on)
 		self.segments.append(Segment(ot * timestep, i * timestep, text))
 			
-	def getCode(self, beg, end, nul_val='!'):
-		for s in self.segments:
+	def getIndex(self, beg, end):
+		for i, s in enumerate(self.segments):
 			if(end < s.xmin):
 				continue
 			if(beg > s.xmax):
 				continue
 			
 			if(end <= s.xmax and beg >= s.xmin):
-				return s.text
+				return i
 			
 			
 			if(beg <= s.xmin):
 				if(end - s.xmin >= s.xmin - beg):
-					return s.text
+					return i
 			
 			if(end >= s.xmax):
 				if(s.xmax - beg >= end - s.xmax):
-					return s.text
+					return i
 			
-		return nul_val
+		return -1
+	
+	def getCode(self, beg, end, nul_val='!'):
+		i = self.getIndex(beg, end)
+		if(i < 0):
+			return nul_val
+		return self.segments[i].text
 	
 	
 	def toSequence(self, nSamples, win_shift, win_size, code_mapping=None, nul_val=-1):
@@ -94,6 +134,26 @@ class PHN:
 				codes.append(c)
 				
 		return codes
+	
+	def toIndices(self, nSamples, win_shift, win_size):
+		beg = numpy.arange(nSamples) * win_shift
+		end = beg + win_size
+		xmin = numpy.array([s.xmin for s in self.segments])
+		xmax = numpy.array([s.xmax for s in self.segments])
+		if(numpy.all(numpy.diff(xmin) >= 0) and numpy.all(numpy.diff(xmax) >= 0)):
+			return alignSegments(xmin, xmax, beg, end)
+		
+		#unsorted segments are checked one window at a time
+		return numpy.array([self.getIndex(b, e) for b, e in zip(beg, end)], dtype=int)
+	
+	def toArray(self, nSamples, win_shift, win_size, code_mapping, nul_val=-1):
+		idx = self.toIndices(nSamples, win_shift, win_size)
+		
+		#the last code is used for windows without a segment (like '!' in toSequence)
+		texts = [s.text.strip() for s in self.segments] + ['!']
+		codes = numpy.array([code_mapping.get(t, nul_val) for t in texts], dtype=int)
+		
+		return codes[idx]
 
 	
 	re_line = re.compile("^([0-9]+) ([0-9]+) (.+)$")
@@ -119,4 +179,53 @@ class PHN:
 			
 			for seg in self.segments:				
 				
-				f.write('{} {} {}\n'.format(seg.xmin,seg.xmax,seg.text))
\ No newline at end of file
+				f.write('{} {} {}\n'.format(seg.xmin,seg.xmax,seg.text))
+
+if __name__ == '__main__':
+	
+	#checks that toArray gives the same labels as toSequence and compares their speed
+	#usage: python PHN.py [TIMIT directory or .phn files...]
+	import os
+	import sys
+	import time
+	
+	win_size = 400
+	win_shift = 160
+	
+	files = []
+	for arg in sys.argv[1:]:
+		if os.path.isdir(arg):
+			for root, dirs, names in os.walk(arg):
+				files.extend([os.path.join(root, n) for n in names if n.lower().endswith('.phn')])
+		else:
+			files.append(arg)
+	
+	mapping = {}
+	t_seq = 0
+	t_arr = 0
+	frames = 0
+	errors = 0
+	for f in files:
+		phn = PHN()
+		phn.load(f)
+		
+		for s in phn.segments:
+			mapping.setdefault(s.text.strip(), len(mapping))
+		
+		n = int((phn.segments[-1].xmax - win_size) // win_shift) + 1
+		
+		t = time.time()
+		seq = phn.toSequence(n, win_shift, win_size, mapping)
+		t_seq += time.time() - t
+		
+		t = time.time()
+		arr = phn.toArray(n, win_shift, win_size, mapping)
+		t_arr += time.time() - t
+		
+		frames += n
+		if(list(arr) != seq):
+			errors += 1
+			print 'Mismatch in ' + f
+	
+	print '{} files, {} frames, {} mismatches'.format(len(files), frames, errors)
+	print 'toSequence: {:.3f}s toArray: {:.3f}s'.format(t_seq, t_arr)
@@ -1,21 +1,110 @@
 import sys
+import time
+import threading
+import multiprocessing
+from Queue import Queue, Full, Empty
 import h5py
+import heapq
 import numpy as np
-from random import shuffle
+from numpy.lib.stride_tricks import as_strided
+from tqdm import *
+
+#top level names in the corpus files that aren't utterances
+reserved_names=['meta','cmvn']
 
 class Corpus:
 
-    def __init__(self,filename,utts_loaded=None,load_normalized=False,merge_utts=False):        
+    def __init__(self,filename,utts_loaded=None,load_normalized=False,merge_utts=False,
+            prefetch=0,prefetch_mode='thread',context=None,columns=None,cmvn=None,
+            rank=0,world_size=1,seed=None,balance=False):        
 
         self.filename=filename
         self.utts_loaded=utts_loaded
         self.load_normalized=load_normalized        
         self.merge_utts=merge_utts
 
+        #number of blocks read ahead while iterating (0 disables prefetching)
+        self.prefetch=prefetch
+        #'thread' or 'process'
+        self.prefetch_mode=prefetch_mode
+        #time (in seconds) the consumer spent waiting for data in the last iteration
+        self.io_wait=0.0
+
+        #(left,right) number of neighbouring frames spliced to each input frame
+        self.context=context
+
+        #subset of feature dimensions (slice or list of indices) read from the file
+        #(set up in _set_columns once the file is open)
+        self.columns=columns
+
+        #this process reads only its own part (rank out of world_size) of each epoch
+        #if seed is set, the order of the utterances in each epoch is reproducible
+        #balance makes the parts equal in the number of frames instead of utterances
+        #all the workers need the same seed, otherwise their parts would overlap
+        if world_size>1 and seed is None:
+            raise ValueError('A seed (shared by all the workers) is required when world_size>1')
+        self.rank=rank
+        self.world_size=world_size
+        self.seed=seed
+        self.balance=balance
+        self.epoch=0
+
+        #cumulative frame offsets of index_utts (built on first use)
+        self.index_utts=None
+        self.frame_offsets=None
+
         self.h5f=h5py.File(filename,'r')
-        self.utts=[]
-        for utt in self.h5f.keys():
-            self.utts.append(utt)
+
+        #packed layout (see pack_corpus) or one group per utterance
+        self.packed='feats' in self.h5f
+        if self.packed:
+            self.offsets=self.h5f['offsets'][()]
+
+        #the metadata table (see save_meta) saves scanning all the utterances in the file
+        if 'meta' in self.h5f:
+            self.meta=self.h5f['meta'][()]
+            self.utts=list(self.meta['name'])
+        else:
+            self.meta=None
+            if self.packed:
+                self.utts=list(self.h5f['names'][()])
+            else:
+                self.utts=[]
+                for utt in self.h5f.keys():
+                    if utt not in reserved_names:
+                        self.utts.append(utt)
+
+        #row of each utterance in the offsets and meta tables
+        self.utt_ids=dict(zip(self.utts,range(len(self.utts))))
+
+        #all the utterances, self.utts is the (shuffled) part read in the current epoch
+        self.all_utts=sorted(self.utts)
+
+        #files without the precomputed 'norm' datasets are normalized on the fly
+        #using the statistics stored by compute_cmvn (or timit.normalize)
+        if self.packed:
+            has_norm='norm' in self.h5f
+        else:
+            has_norm=len(self.utts)>0 and 'norm' in self.h5f[self.utts[0]]
+        self.use_norm=load_normalized and has_norm
+        if load_normalized and not has_norm and not cmvn:
+            cmvn='utt'
+
+        try:
+            self._set_columns(columns)
+        except ValueError:
+            self.h5f.close()
+            raise
+
+        #mean/variance normalization: None, 'utt', 'spk' or 'global' (see compute_cmvn)
+        self.cmvn=cmvn
+        if cmvn:
+            #the file is only read here, the statistics have to be computed beforehand
+            if 'cmvn' not in self.h5f:
+                self.h5f.close()
+                raise ValueError('No normalization statistics (cmvn group) in '+filename+
+                    ', run data.compute_cmvn(filename) or timit.normalize(filename) first')
+            self._load_cmvn()
 
         self.reset_utts_loaded(utts_loaded)
 
@@ -27,28 +116,45 @@ class Corpus:
 
     def reset_utts_loaded(self,utts_loaded):
 
-        if not utts_loaded:
-            utts_loaded=len(self.utts)
+        self.utts_loaded=utts_loaded
+
+        self.reset(self.epoch)
+
+    def _set_blocks(self):
 
         un=len(self.utts)
 
+        utts_loaded=self.utts_loaded
+        if not utts_loaded:
+            utts_loaded=max(un,1)
+
         self.r=range(0,un,utts_loaded)
         self.n=len(self.r)
         self.r.append(un)                
 
-        self.reset()
 
+    def _options(self):
+        return {'filename':self.filename,'utts_loaded':self.utts_loaded,
+            'load_normalized':self.load_normalized,'merge_utts':self.merge_utts,
+            'prefetch':self.prefetch,'prefetch_mode':self.prefetch_mode,
+            'context':self.context,'columns':self.columns,'cmvn':self.cmvn,
+            'rank':self.rank,'world_size':self.world_size,'seed':self.seed,
+            'balance':self.balance}
 
     def split(self,ratio):
-        a=Corpus(filename=self.filename,utts_loaded=self.utts_loaded,
-            load_normalized=self.load_normalized,merge_utts=self.merge_utts)
-        b=Corpus(filename=self.filename,utts_loaded=self.utts_loaded,
-            load_normalized=self.load_normalized,merge_utts=self.merge_utts)
+        a=Corpus(**self._options())
+        b=Corpus(**self._options())
+
+        if self.seed is None:
+            perm=np.random.permutation(len(self.all_utts))
+        else:
+            perm=np.random.RandomState(self.seed).permutation(len(self.all_utts))
+        utts=[self.all_utts[i] for i in perm]
 
-        un_r=int(len(self.utts)*ratio)
+        un_r=int(len(utts)*ratio)
 
-        a.utts=self.utts[:un_r]
-        b.utts=self.utts[un_r:]
+        a.all_utts=sorted(utts[:un_r])
+        b.all_utts=sorted(utts[un_r:])
 
         a.reset_utts_loaded(self.utts_loaded)
         b.reset_utts_loaded(self.utts_loaded)
@@ -57,98 +163,803 @@ class Corpus:
 
 
     def __iter__(self):
-        for c in range(self.n):
-            yield self.get(slice(self.r[c],self.r[c+1]))
+        self.io_wait=0.0
+
+        if self.prefetch>0:
+            blocks=self._prefetch()
+        else:
+            blocks=(self.get(slice(self.r[c],self.r[c+1])) for c in range(self.n))
+
+        try:
+            while True:
+                t=time.time()
+                try:
+                    b=next(blocks)
+                except StopIteration:
+                    break
+                self.io_wait+=time.time()-t
+                yield b
+        finally:
+            blocks.close()
+
+    def _prefetch(self):
+
+        blocks=[self.utts[self.r[c]:self.r[c+1]] for c in range(self.n)]
+
+        if self.prefetch_mode=='process':
+            #the worker process opens its own handle to the file
+            opts=self._options()
+            opts['prefetch']=0
+            q=multiprocessing.Queue(self.prefetch)
+            stop=multiprocessing.Event()
+            w=multiprocessing.Process(target=_prefetch_worker,args=(opts,blocks,q,stop))
+        elif self.prefetch_mode=='thread':
+            q=Queue(self.prefetch)
+            stop=threading.Event()
+            w=threading.Thread(target=_prefetch_worker,args=(self,blocks,q,stop))
+        else:
+            raise ValueError('Unknown prefetch mode: '+str(self.prefetch_mode))
+
+        w.daemon=True
+        w.start()
+
+        try:
+            for c in range(self.n):
+                b=q.get()
+                if isinstance(b,Exception):
+                    raise b
+                yield b
+        finally:
+            stop.set()
+            while w.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except Empty:
+                    pass
+            w.join()
+
+
+    def reset(self,epoch=None):
+
+        if epoch is None:
+            epoch=self.epoch+1
+        self.epoch=epoch
+
+        #all the workers draw the same permutation, so their parts don't overlap
+        #(a seed is required for world_size>1)
+        if self.seed is None:
+            self.rng=np.random
+        else:
+            self.rng=np.random.RandomState([self.seed,epoch])
+        perm=self.rng.permutation(len(self.all_utts))
+
+        self.utts=self._shard([self.all_utts[i] for i in perm])
+
+        if self.world_size>1:
+            self.index_utts=None
+            self.frame_offsets=None
+
+        self._set_blocks()
+
+    def _shard(self,utts):
 
+        if self.world_size==1:
+            return utts
 
-    def reset(self):
-        shuffle(self.utts)
+        if not self.balance:
+            return utts[self.rank::self.world_size]
+
+        #each utterance goes to the worker with the fewest frames so far
+        lens=self._utt_lens(utts)
+        heap=[(0,w) for w in range(self.world_size)]
+        ret=[]
+        for u,l in zip(utts,lens):
+            f,w=heapq.heappop(heap)
+            if w==self.rank:
+                ret.append(u)
+            heapq.heappush(heap,(f+l,w))
+
+        return ret
 
     def close(self):
         self.h5f.close()
 
     def get(self,s=None):
 
-        if self.load_normalized:
-            in_name='norm'
-        else:
-            in_name='in'
-
         if s==None:
             s=slice(None,None)
 
+        return self.read(self.utts[s])
+
+    def _feat_dim(self):
+        if self.packed:
+            return self.h5f[self._in_name()].shape[1]
+        elif len(self.utts)>0:
+            return self.h5f[self.utts[0]][self._in_name()].shape[1]
+        else:
+            return None
+
+    def _set_columns(self,columns):
+
+        #h5py needs the indices in increasing order, the requested order is restored after reading
+        self._col_order=None
+        if columns is None:
+            self._cols=slice(None)
+        elif isinstance(columns,slice):
+            self._cols=columns
+        else:
+            #negative indices count from the end, like in numpy
+            columns=np.array(columns,dtype=np.int64)
+            dim=self._feat_dim()
+            if columns.size==0:
+                raise ValueError('Empty list of columns')
+            if np.any(columns<0):
+                if dim is None:
+                    raise ValueError('Negative columns need the feature size, but the file is empty')
+                columns[columns<0]+=dim
+            if np.any(columns<0) or (dim is not None and np.any(columns>=dim)):
+                raise ValueError('Columns out of range for features of size '+str(dim))
+            c,inv=np.unique(columns,return_inverse=True)
+            if c.size!=len(columns) or np.any(c!=columns):
+                self._col_order=inv
+            if c[-1]-c[0]+1==c.size:
+                self._cols=slice(int(c[0]),int(c[-1])+1)
+            else:
+                self._cols=[int(x) for x in c]
+
+    def _read_feats(self,ds,a=None,b=None):
+        ret=ds[a:b,self._cols]
+        if self._col_order is not None:
+            ret=ret.take(self._col_order,axis=1)
+        return ret
+
+    def _load_cmvn(self):
+
+        g=self.h5f['cmvn']
+
+        if self.cmvn=='global':
+            mean=g['mean'][()][np.newaxis]
+            std=g['std'][()][np.newaxis]
+            self._cmvn_ids=dict.fromkeys(self.all_utts,0)
+        elif self.cmvn=='spk':
+            mean=g['spk_mean'][()]
+            std=g['spk_std'][()]
+            rows=dict(zip(g['spk_names'][()],range(mean.shape[0])))
+            self._cmvn_ids=dict(zip(self.all_utts,[rows[s] for s in self.getSpeakers(self.all_utts)]))
+        elif self.cmvn=='utt':
+            mean=g['utt_mean'][()]
+            std=g['utt_std'][()]
+            rows=dict(zip(g['names'][()],range(mean.shape[0])))
+            self._cmvn_ids=dict(zip(self.all_utts,[rows[u] for u in self.all_utts]))
+        else:
+            raise ValueError('Unknown CMVN mode: '+str(self.cmvn))
+
+        self._cmvn_mean=self._read_feats(mean)
+        self._cmvn_std=self._read_feats(std)
+
+    def _normalize(self,utt,feats):
+        if self.cmvn:
+            r=self._cmvn_ids[utt]
+            feats-=self._cmvn_mean[r]
+            feats/=self._cmvn_std[r]
+        return feats
+
+    def _in_name(self):
+        if self.use_norm:
+            return 'norm'
+        elif self.packed:
+            return 'feats'
+        else:
+            return 'in'
+
+    def _utt_lens(self,utts):
+        if self.meta is not None:
+            ids=np.array([self.utt_ids[u] for u in utts],dtype=np.int64)
+            return self.meta['frames'][ids]
+        elif self.packed:
+            ids=np.array([self.utt_ids[u] for u in utts],dtype=np.int64)
+            return np.diff(self.offsets)[ids]
+        else:
+            return np.array([self.h5f[u+'/out'].shape[0] for u in utts],dtype=np.int64)
+
+    def getSpeakers(self,utts=None):
+        if utts is None:
+            utts=self.utts
+        if self.meta is not None:
+            ids=np.array([self.utt_ids[u] for u in utts],dtype=np.int64)
+            return list(self.meta['speaker'][ids])
+        else:
+            return [get_speaker(u) for u in utts]
+
+    def _read_span(self,utt,a,b):
+        if self.packed:
+            o=self.offsets[self.utt_ids[utt]]
+            feats=self._read_feats(self.h5f[self._in_name()],o+a,o+b)
+            labels=self.h5f['labels'][o+a:o+b]
+        else:
+            g=self.h5f[utt]
+            feats=self._read_feats(g[self._in_name()],a,b)
+            labels=g['out'][a:b]
+        return (self._normalize(utt,feats),labels)
+
+    def _read_packed(self,utts):
+
+        feats=self.h5f[self._in_name()]
+        labels=self.h5f['labels']
+
+        inputs=[]
+        outputs=[]
+        if len(utts)==0:
+            return (inputs,outputs)
+
+        #utterances stored next to each other are read with a single hyperslab
+        #the ids are sorted to find the runs and the pieces are put back in the requested order
+        ids=np.array([self.utt_ids[u] for u in utts],dtype=np.int64)
+        order=np.argsort(ids,kind='mergesort')
+        ids=ids[order]
+        for run in np.split(ids,np.flatnonzero(np.diff(ids)!=1)+1):
+            a=self.offsets[run[0]]
+            z=self.offsets[run[-1]+1]
+            cut=self.offsets[run[1:]]-a
+            inputs.extend(np.split(self._read_feats(feats,a,z),cut))
+            outputs.extend(np.split(labels[a:z],cut))
+
+        inv=np.empty_like(order)
+        inv[order]=np.arange(order.size)
+        inputs=[inputs[i] for i in inv]
+        outputs=[outputs[i] for i in inv]
+
+        if self.cmvn:
+            for i,u in enumerate(utts):
+                self._normalize(u,inputs[i])
+
+        return (inputs,outputs)
+
+    def _read_list(self,utts):
+
+        if self.packed:
+            return self._read_packed(utts)
+
+        in_name=self._in_name()
         inputs=[]
         outputs=[]        
-        for utt in self.utts[s]:
+        for utt in utts:
             g=self.h5f[utt]
-            inputs.append(g[in_name][()])
+            inputs.append(self._normalize(utt,self._read_feats(g[in_name])))
             outputs.append(g['out'][()])
 
+        return (inputs,outputs)
+
+    def _splice_into(self,out,feats):
+        #out has to be contiguous, so the reshape below is a view and not a copy
+        v=out.view()
+        v.shape=(feats.shape[0],sum(self.context)+1,feats.shape[1])
+        v[...]=splice(feats,self.context[0],self.context[1])
+
+    def _stack(self,inputs):
+
+        if not self.context:
+            return np.vstack(inputs)
+
+        w=sum(self.context)+1
+        ret=np.empty((sum([i.shape[0] for i in inputs]),w*inputs[0].shape[1]),dtype=inputs[0].dtype)
+        p=0
+        for i in inputs:
+            self._splice_into(ret[p:p+i.shape[0]],i)
+            p+=i.shape[0]
+
+        return ret
+
+    def read(self,utts):
+
+        inputs,outputs=self._read_list(utts)
+
         if self.merge_utts:
-            inputs=np.vstack(inputs)
+            inputs=self._stack(inputs)
             outputs=np.concatenate(outputs)
         else:
+            if self.context:
+                inputs=[self._stack([i]) for i in inputs]
             inputs=np.array(inputs)
             outputs=np.array(outputs)
 
         return (inputs,outputs)
 
+    def build_frame_index(self):
+
+        if self.frame_offsets is not None:
+            return
+
+        self.index_utts=sorted(self.utts)
+        lens=self._utt_lens(self.index_utts)
+        self.frame_offsets=np.concatenate(([0],np.cumsum(lens)))
+
+    def getFrameNum(self):
+        self.build_frame_index()
+        return int(self.frame_offsets[-1])
+
+    def read_frames(self,idx):
+
+        self.build_frame_index()
+
+        idx=np.asarray(idx,dtype=np.int64)
+        order=np.argsort(idx,kind='mergesort')
+        sidx=idx[order]
+
+        u=np.searchsorted(self.frame_offsets,sidx,side='right')-1
+        b=np.flatnonzero(np.diff(u))+1
+        starts=np.concatenate(([0],b))
+        ends=np.concatenate((b,[sidx.size]))
+
+        inputs=None
+        outputs=None
+        for s,e in zip(starts,ends):
+            l=sidx[s:e]-self.frame_offsets[u[s]]
+            utt=self.index_utts[u[s]]
+
+            #read the smallest span covering the requested frames in one go
+            a=l[0]
+            z=l[-1]+1
+            if self.context:
+                #together with the context, but not past the ends of the utterance
+                n=self.frame_offsets[u[s]+1]-self.frame_offsets[u[s]]
+                a=max(0,a-self.context[0])
+                z=min(n,z+self.context[1])
+                i,o=self._read_span(utt,a,z)
+                i=splice(i,self.context[0],self.context[1])[l-a]
+                i=i.reshape(i.shape[0],-1)
+            else:
+                i,o=self._read_span(utt,a,z)
+                i=i[l-a]
+            o=o[l-a]
+
+            if inputs is None:
+                inputs=np.empty((idx.size,)+i.shape[1:],dtype=i.dtype)
+                outputs=np.empty((idx.size,)+o.shape[1:],dtype=o.dtype)
+
+            inputs[order[s:e]]=i
+            outputs[order[s:e]]=o
+
+        return (inputs,outputs)
+
+    def sample_frames(self,batch_size):
+        idx=self.rng.randint(0,self.getFrameNum(),batch_size)
+        return self.read_frames(idx)
+
+    def iter_frame_batches(self,batch_size,shuffle_frames=True):
+        n=self.getFrameNum()
+        if shuffle_frames:
+            perm=self.rng.permutation(n)
+        else:
+            perm=np.arange(n)
+        for b in range(0,n,batch_size):
+            yield self.read_frames(perm[b:b+batch_size])
+
+    def iter_sequence_batches(self,batch_size,shuffle_batches=True):
+        """ Iterates over the corpus in batches of utterances of similar length.
+
+            Args:
+                batch_size(int): number of utterances in each batch
+
+                shuffle_batches(bool): randomize the order of the batches
+
+            Returns:
+                generator of tuples: inputs(B,T,D float32), outputs(B,T int32), mask(B,T float32)
+                and lengths(B int) where T is the length of the longest utterance in the batch
+
+            Note: the arrays are views into buffers allocated once and reused for each batch, 
+            so they are overwritten by the next iteration. Copy them if they need to be kept.
+        """
+        utts=self.utts
+        lens=self._utt_lens(utts)
+
+        #sorting is stable, so the order set by reset() breaks the ties
+        order=np.argsort(lens,kind='mergesort')
+        batches=[order[b:b+batch_size] for b in range(0,order.size,batch_size)]
+        if shuffle_batches:
+            self.rng.shuffle(batches)
+
+        max_len=lens.max()
+        dim=self._read_span(utts[0],0,1)[0].shape[1]
+        if self.context:
+            dim*=sum(self.context)+1
+
+        in_buf=np.empty(batch_size*max_len*dim,dtype=np.float32)
+        out_buf=np.empty(batch_size*max_len,dtype=np.int32)
+        mask_buf=np.empty(batch_size*max_len,dtype=np.float32)
+
+        for b in batches:
+            B=b.size
+            T=lens[b].max()
+
+            inputs=in_buf[:B*T*dim].reshape(B,T,dim)
+            outputs=out_buf[:B*T].reshape(B,T)
+            mask=mask_buf[:B*T].reshape(B,T)
+
+            ins,outs=self._read_list([utts[u] for u in b])
+            for i in range(B):
+                l=lens[b[i]]
+                if self.context:
+                    self._splice_into(inputs[i,:l],ins[i])
+                else:
+                    inputs[i,:l]=ins[i]
+                inputs[i,l:]=0
+                outputs[i,:l]=outs[i]
+                outputs[i,l:]=0
+                mask[i,:l]=1
+                mask[i,l:]=0
+
+            yield (inputs,outputs,mask,lens[b])
+
     def getMaxLen(self):
+        if self.meta is not None:
+            return int(self.meta['frames'].max())
+        if self.packed:
+            return int(np.diff(self.offsets).max())
         m=0
         for u in self.h5f:    
+            if u in reserved_names:
+                continue
             if m<self.h5f[u+'/out'].size:
                 m=self.h5f[u+'/out'].size
         return m
 
+def splice(feats,left,right):
+    """ Splices the neighbouring frames to each frame of the utterance.
+
+        Args:
+            feats(numpy array): TxD matrix of features
+
+            left(int): number of previous frames
+
+            right(int): number of following frames
+
+        Returns:
+            numpy array: Tx(left+right+1)xD read-only view, where the first and last frames are
+            repeated at the edges of the utterance
+
+        Note: only the padded copy of the input is allocated. The frames are shared between the 
+        windows, so reshaping the result into a Tx((left+right+1)*D) matrix makes the copy.
+    """
+    padded=np.pad(feats,((left,right),(0,0)),mode='edge')
+    s0,s1=padded.strides
+    ret=as_strided(padded,shape=(feats.shape[0],left+right+1,feats.shape[1]),strides=(s0,s0,s1))
+    ret.flags.writeable=False
+    return ret
+
+def _combine_stats(a,b):
+    #merges the (count,mean,M2) statistics of two sets of frames (Chan et al.)
+    na,ma,m2a=a
+    nb,mb,m2b=b
+    n=na+nb
+    if n==0:
+        return a
+    d=mb-ma
+    return (n,ma+d*(float(nb)/n),m2a+m2b+d*d*(float(na)*nb/n))
+
+def _stats_std(n,m2):
+    std=np.sqrt(m2/max(n,1))
+    std[std==0]=1
+    return std
+
+def compute_cmvn(filename,block=100):
+    """ Computes the mean and variance normalization statistics of a corpus file and
+        saves them into its 'cmvn' group.
+
+        Args:
+            filename(string): path to the HDF5 corpus (in any layout supported by Corpus)
+
+            block(int): number of utterances read at once
+
+        Returns: nothing
+
+        Note: the statistics are computed per dimension for each utterance, each speaker and
+        the whole corpus. The utterance statistics are merged using the pairwise update of 
+        Chan et al., which (unlike summing squares) stays accurate on large corpora.
+    """
+    c=Corpus(filename)
+
+    names=sorted(c.utts)
+    speakers=c.getSpeakers(names)
+
+    utt_stats=[]
+    for b in tqdm(range(0,len(names),block)):
+        inputs,outputs=c._read_list(names[b:b+block])
+        for x in inputs:
+            x=x.astype(np.float64)
+            m=x.mean(axis=0)
+            utt_stats.append((x.shape[0],m,((x-m)**2).sum(axis=0)))
+
+    c.close()
+
+    dim=utt_stats[0][1].size
+    zero=(0,np.zeros(dim),np.zeros(dim))
+
+    spk_names=sorted(set(speakers))
+    spk_rows=dict(zip(spk_names,range(len(spk_names))))
+    spk_stats=[zero]*len(spk_names)
+    for st,spk in zip(utt_stats,speakers):
+        r=spk_rows[spk]
+        spk_stats[r]=_combine_stats(spk_stats[r],st)
+
+    glob=zero
+    for st in spk_stats:
+        glob=_combine_stats(glob,st)
+
+    h5f=h5py.File(filename,'r+')
+
+    if 'cmvn' in h5f:
+        del h5f['cmvn']
+    g=h5f.create_group('cmvn')
+
+    g['names']=np.array(names,dtype='S')
+    g['utt_mean']=np.array([st[1] for st in utt_stats])
+    g['utt_std']=np.array([_stats_std(st[0],st[2]) for st in utt_stats])
+    g['spk_names']=np.array(spk_names,dtype='S')
+    g['spk_mean']=np.array([st[1] for st in spk_stats])
+    g['spk_std']=np.array([_stats_std(st[0],st[2]) for st in spk_stats])
+    g['mean']=glob[1]
+    g['std']=_stats_std(glob[0],glob[2])
+
+    h5f.close()
+
+def get_speaker(name):
+    #TIMIT utterances are named as speaker_sentence
+    return name.split('_')[0]
+
+def save_meta(h5f,names,frames,speakers,offsets=None):
+    """ Saves the metadata table of the corpus into an open HDF5 file.
+
+        Args:
+            h5f(h5py.File): file opened for writing
+
+            names(list): names of the utterances
+
+            frames(list): number of frames in each utterance
+
+            speakers(list): speaker of each utterance
+
+            offsets(list): offset of each utterance in the packed layout (or None if the file
+                isn't packed)
+
+        Note: the table is stored as a single compound dataset named 'meta', so the Corpus
+        class can read it in one go instead of opening each utterance to check its size.
+    """
+    names=np.array(names,dtype='S')
+    speakers=np.array(speakers,dtype='S')
+
+    meta=np.empty(names.size,dtype=[('name',names.dtype),('frames',np.int64),
+        ('speaker',speakers.dtype),('offset',np.int64)])
+    meta['name']=names
+    meta['frames']=frames
+    meta['speaker']=speakers
+    if offsets is None:
+        meta['offset']=-1
+    else:
+        meta['offset']=offsets
+
+    if 'meta' in h5f:
+        del h5f['meta']
+    h5f['meta']=meta
+
+def add_meta(filename):
+    """ Adds the metadata table to an existing corpus file (stored one group per utterance). """
+    h5f=h5py.File(filename,'r+')
+
+    names=[u for u in h5f.keys() if u not in reserved_names]
+    frames=[h5f[u+'/out'].shape[0] for u in names]
+    speakers=[get_speaker(u) for u in names]
+
+    save_meta(h5f,names,frames,speakers)
+
+    h5f.close()
+
+def pack_corpus(infile,outfile,column_chunks=False):
+    """ Converts a corpus stored as one group per utterance (with 'in', 'out' and optionally
+        'norm' datasets) into the packed layout: all the features are stored in a single 'feats'
+        matrix, all the labels in a single 'labels' vector and the utterances are located using
+        the 'offsets' and 'names' tables. Utterance i spans rows offsets[i]:offsets[i+1].
+
+        If column_chunks is set, the feature matrices are chunked by column, so reading only
+        a subset of the dimensions (see the columns argument of Corpus) doesn't touch the rest.
+    """
+    src=h5py.File(infile,'r')
+
+    names=sorted([u for u in src.keys() if u not in reserved_names])
+    lens=np.array([src[u+'/out'].shape[0] for u in names],dtype=np.int64)
+    offsets=np.concatenate(([0],np.cumsum(lens)))
+
+    g=src[names[0]]
+
+    dst=h5py.File(outfile,'w')
+
+    data=[('in','feats'),('out','labels')]
+    if 'norm' in g:
+        data.append(('norm','norm'))
+
+    for sn,dn in data:
+        shape=(offsets[-1],)+g[sn].shape[1:]
+        chunks=None
+        if column_chunks and len(shape)==2:
+            chunks=(min(shape[0],65536),1)
+        dst.create_dataset(dn,shape,dtype=g[sn].dtype,chunks=chunks)
+
+    for i,u in enumerate(tqdm(names)):
+        for sn,dn in data:
+            dst[dn][offsets[i]:offsets[i+1]]=src[u][sn][()]
+
+    dst['offsets']=offsets
+    dst['names']=np.array(names,dtype='S')
+
+    if 'meta' in src:
+        meta=src['meta'][()]
+        spk=dict(zip(meta['name'],meta['speaker']))
+        speakers=[spk[u] for u in names]
+    else:
+        speakers=[get_speaker(u) for u in names]
+    save_meta(dst,names,lens,speakers,offsets[:-1])
+
+    if 'cmvn' in src:
+        src.copy('cmvn',dst)
+
+    dst.close()
+    src.close()
+
+def _prefetch_worker(corpus,blocks,q,stop):
+
+    own=isinstance(corpus,dict)
+    if own:
+        corpus=Corpus(**corpus)
+
+    try:
+        for b in blocks:
+            d=corpus.read(b)
+            while not stop.is_set():
+                try:
+                    q.put(d,timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if stop.is_set():
+                break
+    except Exception as e:
+        q.put(e)
+    finally:
+        if own:
+            corpus.close()
+
 class Report:
-    def __init__(self):
-        self.loss=[]
-        self.acc=[]
-        self.samp_num=[]
+    """ Accumulates the results of a single epoch.
+
+        Only running sums are kept, so the memory use doesn't depend on the number of batches.
+
+        Args:
+            classes(int): number of classes in the confusion matrix (if None, it is taken
+                from the mapping or grows with the largest label seen)
+
+            mapping(numpy array): lookup table used to fold the labels before counting them in
+                the confusion matrix (eg. timit.phoneset.mapping(61,39)). Frames mapped to 
+                negative values (like q) are left out.
+    """
+    def __init__(self,classes=None,mapping=None):
+        self.loss_sum=0.0
+        self.loss_num=0
+        self.acc_sum=0.0
+        self.samp_sum=0
+        #totals of the edit operations (S,D,I,N) from score.Scorer
+        self.edit_tot=np.zeros(4)
+        #pending results of Scorer.submit
+        self.edits=[]
+
+        self.mapping=mapping
+        if classes is None and mapping is not None:
+            classes=int(mapping.max())+1
+        self.confusion=None
+        if classes:
+            self.confusion=np.zeros((classes,classes),dtype=np.int64)
     
     def addL(self,loss):
         if type(loss) is list:
-            self.loss.extend(loss)    
+            self.loss_sum+=np.sum(loss)
+            self.loss_num+=len(loss)
         else:
-            self.loss.append(loss)
+            self.loss_sum+=loss
+            self.loss_num+=1
                 
     def addLA(self,loss,acc,samp_num):
-        if type(loss) is list:
-            self.loss.extend(loss)    
-        else:
-            self.loss.append(loss)        
+        self.addL(loss)
         if type(samp_num) is list:
-            self.samp_num.extend(samp_num)              
-            self.acc.extend(acc)
+            self.samp_sum+=np.sum(samp_num)
+            self.acc_sum+=np.dot(acc,samp_num)
         else:
-            self.samp_num.append(samp_num)
-            self.acc.append(acc)
+            self.samp_sum+=samp_num
+            self.acc_sum+=acc*samp_num
 
     def getMeanLoss(self):
-        return np.mean(self.loss)
+        if self.loss_num==0:
+            return float('nan')
+        return self.loss_sum/self.loss_num
     
     def getAveAcc(self):
-        if len(self.acc)==0:
+        if self.samp_sum==0:
             return 0
         else:
-            return np.average(self.acc,weights=self.samp_num)
+            return self.acc_sum/self.samp_sum
+
+    def addPER(self,edits):
+        if hasattr(edits,'get'):
+            self.edits.append(edits)
+        else:
+            self.edit_tot+=edits
+
+    def getPER(self):
+        for e in self.edits:
+            self.edit_tot+=e.get()
+        self.edits=[]
+        S,D,I,N=self.edit_tot
+        if N==0:
+            return None
+        return (S+D+I)/N
+
+    def addConfusion(self,ref,hyp):
+        """ Counts the frames of the reference (ref) and recognized (hyp) label arrays in the
+            confusion matrix (indexed as [ref,hyp]).
+        """
+        ref=np.asarray(ref).ravel()
+        hyp=np.asarray(hyp).ravel()
+
+        if self.mapping is not None:
+            ref=self.mapping[ref]
+            hyp=self.mapping[hyp]
+            keep=(ref>=0)&(hyp>=0)
+            ref=ref[keep]
+            hyp=hyp[keep]
+
+        if ref.size==0:
+            return
+
+        n=max(ref.max(),hyp.max())+1
+        if self.confusion is None:
+            self.confusion=np.zeros((n,n),dtype=np.int64)
+        elif n>self.confusion.shape[0]:
+            c=np.zeros((n,n),dtype=np.int64)
+            k=self.confusion.shape[0]
+            c[:k,:k]=self.confusion
+            self.confusion=c
+
+        k=self.confusion.shape[0]
+        self.confusion+=np.bincount(ref*k+hyp,minlength=k*k).reshape(k,k)
+
+    def getConfusionAcc(self):
+        if self.confusion is None or self.confusion.sum()==0:
+            return 0
+        return float(np.trace(self.confusion))/self.confusion.sum()
     
     def printout(self,title):
         print '{} loss: {}'.format(title,self.getMeanLoss())
-        if len(self.acc)>0:
-            print '{} PER: {:%}'.format(title,1-self.getAveAcc())     
+        if self.samp_sum>0:
+            print '{} FER: {:%}'.format(title,1-self.getAveAcc())     
+        per=self.getPER()
+        if per is not None:
+            print '{} PER: {:%}'.format(title,per)
         sys.stdout.flush()
 
 class History:
-    def __init__(self, name):
+    def __init__(self, name, classes=None, mapping=None):
         self.name=name
-        self.r=Report()
+        self.classes=classes
+        self.mapping=mapping
+        self.r=Report(classes,mapping)
         self.loss=[]
         self.acc=[]
+        self.per=[]
+        #confusion matrix of the last logged epoch
+        self.confusion=None
 
     def log(self):
         self.r.printout(self.name)
         self.loss.append(self.r.getMeanLoss())
         self.acc.append(self.r.getAveAcc())
-        self.r=Report()
-
+        self.per.append(self.r.getPER())
+        self.confusion=self.r.confusion
+        self.r=Report(self.classes,self.mapping)
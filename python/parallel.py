@@ -0,0 +1,12 @@
+import collections
+
+def imap_window(pool,func,tasks,window):
+    #like pool.imap, but doesn't read more than window tasks ahead of the results
+    #(limits the memory used by the results waiting to be consumed)
+    pending=collections.deque()
+    for t in tasks:
+        pending.append(pool.apply_async(func,(t,)))
+        if len(pending)>=window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,166 @@
+import numpy as np
+from multiprocessing import Pool
+
+def collapse(frames,mapping=None):
+    """ Converts a sequence of frame labels into a sequence of phonemes.
+
+        Args:
+            frames(numpy array): label of each frame
+
+            mapping(numpy array): optional lookup table applied to the labels before collapsing
+                (eg. the 61->39 reduction from timit.phoneset.mapping(61,39)). Labels mapped
+                to negative values (like q) are removed.
+
+        Returns:
+            numpy array: labels with the repetitions of the same label merged into one
+    """
+    frames=np.asarray(frames)
+    if mapping is not None:
+        frames=mapping[frames]
+        frames=frames[frames>=0]
+    if frames.size==0:
+        return frames
+    return frames[np.concatenate(([True],frames[1:]!=frames[:-1]))]
+
+def _pad(seqs,val):
+    lens=np.array([len(s) for s in seqs],dtype=np.int64)
+    ret=np.empty((len(seqs),max(lens.max(),1)),dtype=np.int64)
+    ret.fill(val)
+    for i,s in enumerate(seqs):
+        ret[i,:len(s)]=s
+    return ret,lens
+
+def edit_ops(refs,hyps):
+    """ Aligns a batch of reference and hypothesis sequences using the Levenshtein distance.
+
+        Args:
+            refs(list): reference sequences (numpy arrays of ints)
+
+            hyps(list): hypothesis sequences (numpy arrays of ints)
+
+        Returns:
+            tuple: numbers of substitutions, deletions and insertions in each utterance and the
+            lengths of the references (4 numpy arrays)
+
+        Note: the dynamic programming is vectorized over the whole batch. Each row of the cost
+        matrix is computed at once: the insertions along the row are a running minimum
+        (np.minimum.accumulate), so the only Python loops are over the rows and the backtrace.
+    """
+    B=len(refs)
+    ref,lr=_pad(refs,-1)
+    hyp,lh=_pad(hyps,-2)
+    R=ref.shape[1]
+    H=hyp.shape[1]
+
+    cols=np.arange(H+1)
+
+    D=np.empty((B,R+1,H+1),dtype=np.int32)
+    D[:,0,:]=cols
+    for i in range(1,R+1):
+        sub=(ref[:,i-1,np.newaxis]!=hyp)
+        t=np.minimum(D[:,i-1,1:]+1,D[:,i-1,:-1]+sub)
+        t=np.concatenate((np.full((B,1),i,dtype=np.int32),t),axis=1)-cols
+        D[:,i,:]=np.minimum.accumulate(t,axis=1)+cols
+
+    S=np.zeros(B,dtype=np.int64)
+    Dl=np.zeros(B,dtype=np.int64)
+    I=np.zeros(B,dtype=np.int64)
+
+    #backtrace of all the utterances at once, preferring the diagonal moves
+    i=lr.copy()
+    j=lh.copy()
+    while True:
+        a=np.flatnonzero((i>0)|(j>0))
+        if a.size==0:
+            break
+        ia=i[a]
+        ja=j[a]
+        pi=np.maximum(ia-1,0)
+        pj=np.maximum(ja-1,0)
+
+        cur=D[a,ia,ja]
+        sub=ref[a,pi]!=hyp[a,pj]
+        diag=(ia>0)&(ja>0)&(cur==D[a,pi,pj]+sub)
+        dele=~diag&(ia>0)&(cur==D[a,pi,ja]+1)
+        ins=~diag&~dele
+
+        S[a]+=diag&sub
+        Dl[a]+=dele
+        I[a]+=ins
+        i[a]-=diag|dele
+        j[a]-=diag|ins
+
+    return (S,Dl,I,lr)
+
+def _score_chunk(args):
+    refs,hyps=args
+    S,D,I,N=edit_ops(refs,hyps)
+    return np.array([S.sum(),D.sum(),I.sum(),N.sum()])
+
+class PendingScore:
+    """ Result of Scorer.submit, call get() to wait for the (S,D,I,N) totals. """
+    def __init__(self,result):
+        self.result=result
+
+    def get(self):
+        #an empty set of utterances has no chunks, but still sums to (0,0,0,0)
+        totals=np.array(self.result.get(),dtype=np.int64).reshape(-1,4)
+        return tuple(totals.sum(axis=0))
+
+class Scorer:
+    """ Computes the phone error rate (PER) of frame level outputs.
+
+        Args:
+            mapping(numpy array): lookup table used to fold the labels (eg. 61->39)
+
+            workers(int): number of processes used for scoring (None means all the cores)
+
+            chunk(int): number of utterances aligned at once by a single worker
+
+        Example:
+            scorer=Scorer(timit.phoneset.mapping(61,39))
+            dev_hist.r.addPER(scorer.submit(dev_out_dec,dev_pred))
+            ...
+            dev_hist.log()
+    """
+    def __init__(self,mapping=None,workers=None,chunk=256):
+        self.mapping=mapping
+        self.chunk=chunk
+        self.pool=Pool(workers)
+
+    def _chunks(self,refs,hyps):
+        refs=[collapse(r,self.mapping) for r in refs]
+        hyps=[collapse(h,self.mapping) for h in hyps]
+        #sorting by length keeps the padding in each chunk small
+        order=np.argsort([len(r) for r in refs],kind='mergesort')
+        ret=[]
+        for b in range(0,order.size,self.chunk):
+            o=order[b:b+self.chunk]
+            ret.append(([refs[k] for k in o],[hyps[k] for k in o]))
+        return ret
+
+    def submit(self,refs,hyps):
+        """ Starts scoring the frame label sequences in the background.
+
+            Args:
+                refs(list): reference frame labels of each utterance
+
+                hyps(list): recognized frame labels of each utterance
+
+            Returns:
+                PendingScore: object whose get() method returns the totals of substitutions,
+                deletions, insertions and reference phonemes
+        """
+        return PendingScore(self.pool.map_async(_score_chunk,self._chunks(refs,hyps)))
+
+    def score(self,refs,hyps):
+        """ Same as submit, but waits for the result. """
+        return self.submit(refs,hyps).get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def per(result):
+    S,D,I,N=result
+    return float(S+D+I)/max(N,1)
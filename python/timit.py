@@ -1,7 +1,11 @@
 import sys
+import re
 import numpy as np
 from scipy.io.wavfile import read
 import os
+import time
+import itertools
+from multiprocessing import Pool, cpu_count
 import h5py
 from tqdm import *
 
@@ -9,6 +13,8 @@ sys.path.append('../PyHTK/python')
 
 from HTKFeat import MFCC_HTK
 from PHN import PHN
+from data import save_meta, get_speaker, compute_cmvn, reserved_names
+from parallel import imap_window
 
 class Segment:
     def __init__(self):
@@ -18,41 +24,107 @@ class Segment:
     def __str__(self):
         return '({},{}) "{}" '.format(self.beg,self.end,self.text)
 
-def load_mlf(path):    
+class MLF:
+    """ Alignments of a whole MLF file stored as flat arrays.
+
+        Properties:
+            names(list): names of the utterances
+
+            offsets(numpy array): segments of utterance i are at offsets[i]:offsets[i+1]
+
+            beg(numpy array): first frame of each segment
+
+            end(numpy array): end frame (exclusive) of each segment
+
+            state(numpy array): id of the label of each segment (index into labels)
+
+            labels(list): names of the labels (states)
+    """
+    def __init__(self):
+        self.names=[]
+        self.offsets=None
+        self.beg=None
+        self.end=None
+        self.state=None
+        self.labels=[]
+
+    def __len__(self):
+        return len(self.names)
+
+    def segments(self,i):
+        s=slice(self.offsets[i],self.offsets[i+1])
+        return (self.beg[s],self.end[s],self.state[s])
+
+#matches either the utterance name or the segment lines (the '.' terminators are skipped)
+_mlf_re=re.compile(r'^(?:"([^"\n]*)"|(\d+) (\d+) (\S+)[^\n]*)$',re.M)
+
+def load_mlf_arrays(path,cache=True):
+    """ Loads the MLF file into an MLF object.
+
+        The whole file is tokenized at once and converted to numpy arrays. If cache is set,
+        the arrays are saved next to the MLF (path+'.npz') and reused on later calls, as long
+        as the modification time of the MLF doesn't change.
+    """
+    mtime=os.path.getmtime(path)
+    cache_file=path+'.npz'
+
+    ret=MLF()
+
+    if cache and os.path.exists(cache_file):
+        with np.load(cache_file) as d:
+            if d['mtime']==mtime:
+                ret.names=d['names'].tolist()
+                ret.offsets=d['offsets']
+                ret.beg=d['beg']
+                ret.end=d['end']
+                ret.state=d['state']
+                ret.labels=d['labels'].tolist()
+                return ret
+
     with open(path,'r') as F:
-        
-        assert F.readline()[:-1] == '#!MLF!#'
-        
-        ret={}        
-        while True:                        
-            name=F.readline()
-            
-            if name == '':
-                break
-            
-            #remove newline,quotes and extension
-            name=name[1:-6]
-            name='_'.join(name.split('-')[2:])
-            
-            segs=[]
-            while True:
-                
-                line = F.readline()
-       
-                if line[:-1] == '.':
-                    break
-                
-                seg=Segment()
-                
-                arr=line.split(' ')
-                
-                seg.beg=int(arr[0])/100000
-                seg.end=int(arr[1])/100000
-                seg.text=arr[2]
-                
-                segs.append(seg)
-            
-            ret[name]=segs            
+        text=F.read()
+
+    assert text.startswith('#!MLF!#')
+
+    toks=np.array(_mlf_re.findall(text))
+
+    is_name=toks[:,0]!=''
+    seg=toks[~is_name]
+
+    #remove quotes and extension
+    ret.names=['_'.join(n[:-4].split('-')[2:]) for n in toks[is_name,0]]
+    ret.offsets=np.concatenate((np.cumsum(~is_name)[is_name],[seg.shape[0]]))
+    ret.beg=seg[:,1].astype(np.int64)//100000
+    ret.end=seg[:,2].astype(np.int64)//100000
+    labels,ret.state=np.unique(seg[:,3],return_inverse=True)
+    ret.labels=labels.tolist()
+
+    if cache:
+        try:
+            tmp=cache_file+'.tmp'
+            with open(tmp,'wb') as f:
+                np.savez(f,mtime=mtime,names=np.array(ret.names),offsets=ret.offsets,beg=ret.beg,
+                    end=ret.end,state=ret.state,labels=labels)
+            os.rename(tmp,cache_file)
+        except (IOError,OSError):
+            pass
+
+    return ret
+
+def load_mlf(path):    
+
+    mlf=load_mlf_arrays(path)
+
+    ret={}
+    for i,name in enumerate(mlf.names):
+        segs=[]
+        for b,e,st in zip(*mlf.segments(i)):
+            seg=Segment()
+            seg.beg=int(b)
+            seg.end=int(e)
+            seg.text=mlf.labels[st]
+            segs.append(seg)
+        ret[name]=segs
     return ret
 
 class Utt:
@@ -71,8 +143,15 @@ def prepare_corp(mlf,statelist,audio_path):
             states[s[:-1]]=c
             c+=1
     
+    if isinstance(mlf,MLF):
+        #labels of the segments in the statelist numbering
+        label_ids=np.array([states[l] for l in mlf.labels])
+        items=[(n,mlf.segments(i)) for i,n in enumerate(mlf.names)]
+    else:
+        items=mlf.items()
+
     ret=[]
-    for utt_name,segs in tqdm(mlf.items()):
+    for utt_name,segs in tqdm(items):
         
         utt=Utt()
         
@@ -87,13 +166,81 @@ def prepare_corp(mlf,statelist,audio_path):
         
         assert fs == 16000
         
-        for seg in segs:
-            utt.phones.append(states[seg.text])
-            utt.ph_lens.append(seg.end-seg.beg)
+        if isinstance(mlf,MLF):
+            beg,end,st=segs
+            utt.phones=label_ids[st].tolist()
+            utt.ph_lens=(end-beg).tolist()
+        else:
+            for seg in segs:
+                utt.phones.append(states[seg.text])
+                utt.ph_lens.append(seg.end-seg.beg)
         
         ret.append(utt)
     return ret
 
+_ph_map=None
+
+def _timit61_map():
+    global _ph_map
+    if _ph_map is None:
+        fixes={'h\\#':'h#','ax-h':'axh'}
+        _ph_map=dict(phoneset.ids[61])
+        for k,v in fixes.items():
+            _ph_map[k]=_ph_map[v]
+    return _ph_map
+
+def prepare_utt(f,path,win_len=0.025,win_shift=0.01,mmap=False):
+    """ Loads a single TIMIT utterance (WAV file and PHN alignment) from the corpus directory.
+
+        If mmap is set, the audio is memory-mapped instead of being read into memory.
+    """
+    utt=Utt()
+   
+    utt.name=f
+    
+    fs,utt.data=read(path+'/'+f+'.wav',mmap=mmap)
+    
+    assert fs == 16000
+
+    tg_file=path+'/'+f+'.phn'
+
+    if not os.path.exists(tg_file):
+        raise IOError(tg_file)
+    
+    phn=PHN()
+    phn.load(tg_file)
+
+    win_len_s=win_len*fs
+    win_shift_s=win_shift*fs
+
+    win_num=np.floor((utt.data.size-win_len_s)/win_shift_s).astype('int')+1
+
+    if phn.segments[0].xmin > 0:
+        phn.segments[0].xmin = 0
+
+    if phn.segments[-1].xmax < utt.data.size:
+        phn.segments[-1].xmax = utt.data.size
+
+    seq=phn.toArray(win_num,win_shift_s,win_len_s,_timit61_map())
+
+    if np.any(seq<0):
+        raise RuntimeError('Error in file '+f)
+
+    #run-length encoding of the frame labels
+    b=np.concatenate(([0],np.flatnonzero(np.diff(seq))+1,[seq.size]))
+    utt.phones=seq[b[:-1]].tolist()
+    utt.ph_lens=np.diff(b).tolist()
+
+    return utt
+
+def iter_corp_dir(list_file,path,win_len=0.025,win_shift=0.01,mmap=True):
+    """ Generator version of prepare_corp_dir, which loads the utterances one at a time. """
+    with open(list_file) as f:
+        file_list=f.read().splitlines()
+
+    for f in file_list:
+        yield prepare_utt(f,path,win_len,win_shift,mmap)
+
 def prepare_corp_dir(list_file,path,win_len=0.025,win_shift=0.01):
 
     with open(list_file) as f:
@@ -101,109 +248,166 @@ def prepare_corp_dir(list_file,path,win_len=0.025,win_shift=0.01):
 
     ret=[]
     for f in tqdm(file_list):
-        utt=Utt()
-       
-        utt.name=f
-        
-        fs,utt.data=read(path+'/'+f+'.wav')
-        
-        assert fs == 16000
+        ret.append(prepare_utt(f,path,win_len,win_shift))
+    return ret
 
-        tg_file=path+'/'+f+'.phn'
+_mfcc=None
 
-        if not os.path.exists(tg_file):
-            raise IOError(tg_file)
-        
-        phn=PHN()
-        phn.load(tg_file)
+def compute_features(utt):
+    """ Computes the MFCC+delta+acceleration features and the frame labels of an utterance.
 
-        win_len_s=win_len*fs
-        win_shift_s=win_shift*fs
+        Returns:
+            tuple: name of the utterance, features(numpy array) and labels(numpy array)
+    """
+    global _mfcc
+    #each worker process creates its own extractor
+    if _mfcc is None:
+        _mfcc=MFCC_HTK()
 
-        win_num=np.floor((utt.data.size-win_len_s)/win_shift_s).astype('int')+1
+    feat=_mfcc.get_feats(utt.data.astype(np.float64))
+    delta=_mfcc.get_delta(feat)
+    acc=_mfcc.get_delta(delta)
 
-        if phn.segments[0].xmin > 0:
-            phn.segments[0].xmin = 0
+    feat=np.hstack((feat,delta,acc))
+    utt_len=feat.shape[0]
 
-        if phn.segments[-1].xmax < utt.data.size:
-            phn.segments[-1].xmax = utt.data.size
+    o=[]
+    for i in range(len(utt.phones)):
+        num=utt.ph_lens[i]
+        o.extend([utt.phones[i]]*num)
 
-        seq=phn.toSequence(win_num,win_shift_s,win_len_s)
+    # here we fix an off-by-one error that happens very inrequently
+    if utt_len-len(o)==1:
+        o.append(o[-1])
 
-        fixes={'h\\#':'h#','ax-h':'axh'}
+    if len(o) != utt_len:
+        print utt.name
+        print len(o)
+        print utt_len
+    
+    assert len(o)==utt_len
+
+    return (utt.name,feat,np.array(o))
+
+def _prepare_features(task):
+    return compute_features(prepare_utt(*task,mmap=True))
+
+def _run_extraction(savefile,get_tasks,func,workers,window,flush_every):
+
+    #the workers are forked before the file is opened, so they don't inherit the HDF5 handle
+    pool=None
+    if workers!=1:
+        pool=Pool(workers)
+        if not window:
+            window=4*(workers or cpu_count())
+
+    try:
+        h5f=h5py.File(savefile,'a')
+    except:
+        if pool:
+            pool.terminate()
+        raise
+
+    #groups without labels weren't written completely before the last run was interrupted
+    done=set()
+    for u in h5f.keys():
+        if u in reserved_names:
+            continue
+        if 'out' in h5f[u]:
+            done.add(u)
+        else:
+            del h5f[u]
 
-        lc=-1
-        for ph in seq:
-            if ph in fixes:
-                ph = fixes[ph]
-            if ph not in timit61:
-                raise RuntimeError('Error in file '+f)
-            c=timit61.index(ph)
-            if c!=lc:
-                utt.phones.append(c)
-                utt.ph_lens.append(1)
-                lc=c
-            else:
-                utt.ph_lens[-1]+=1
+    todo=get_tasks(done)
 
-        ret.append(utt)
-    return ret
+    if pool is None:
+        results=itertools.imap(func,todo)
+    else:
+        results=imap_window(pool,func,todo,window)
 
-def extract_features(corpus, savefile):
-    
-    mfcc=MFCC_HTK()
-    h5f=h5py.File(savefile,'w')
+    num=0
+    start=time.time()
+    try:
+        for name,feat,o in tqdm(results):
+
+            g=h5f.create_group('/'+name)
+            
+            g['in']=feat
+            g['out']=o
+
+            num+=1
+            if num%flush_every==0:
+                h5f.flush()
+    except:
+        if pool:
+            pool.terminate()
+        h5f.close()
+        raise
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    elapsed=time.time()-start
+    print 'Extracted {} utterances in {:.1f}s ({:.1f} utts/sec), skipped {}'.format(num,
+        elapsed,num/max(elapsed,1e-6),len(done))
+
+    if num>0:
+        #the statistics are stale now
+        if 'cmvn' in h5f:
+            del h5f['cmvn']
+
+        names=[u for u in h5f.keys() if u not in reserved_names]
+        frames=[h5f[u+'/out'].shape[0] for u in names]
+        save_meta(h5f,names,frames,[get_speaker(n) for n in names])
     
-    for utt in tqdm(corpus):
+    h5f.close()
 
-        feat=mfcc.get_feats(utt.data.astype(np.float64))
-        delta=mfcc.get_delta(feat)
-        acc=mfcc.get_delta(delta)
+def extract_features(corpus, savefile, workers=None, flush_every=100, window=None):
+    """ Computes the features of the corpus and saves them in an HDF5 file.
 
-        feat=np.hstack((feat,delta,acc))
-        utt_len=feat.shape[0]
+        Args:
+            corpus(iterable): Utt objects, as returned by prepare_corp, prepare_corp_dir or
+                iter_corp_dir
 
-        o=[]
-        for i in range(len(utt.phones)):
-            num=utt.ph_lens[i]
-            o.extend([utt.phones[i]]*num)
+            savefile(string): path to the output file
 
-        # here we fix an off-by-one error that happens very inrequently
-        if utt_len-len(o)==1:
-            o.append(o[-1])
+            workers(int): number of processes computing the features (None uses all the cores
+                and 1 computes everything in the calling process)
 
-        if len(o) != utt_len:
-            print utt.name
-            print len(o)
-            print utt_len
-            h5f.close()
-        
-        assert len(o)==utt_len
+            flush_every(int): number of utterances written between flushes of the file
 
-        g=h5f.create_group('/'+utt.name)
-        
-        g['in']=feat
-        g['out']=o
-        
-        h5f.flush()
-    
-    h5f.close()
+            window(int): maximum number of utterances being processed at once (None means 4 
+                per worker)
 
-def normalize(corp_file):
-    
-    h5f=h5py.File(corp_file)
+        Returns: nothing
 
-    b=0
-    for utt in tqdm(h5f):
-        
-        f=h5f[utt]['in']
-        n=f-np.mean(f)
-        n/=np.std(n)        
-        h5f[utt]['norm']=n
-        
-        h5f.flush()
-        
-    h5f.close()
+        Note: the features are computed in parallel, but only the calling process writes to
+        the file. The file is appended to and the utterances already present in it are 
+        skipped, so an interrupted extraction can be resumed by running it again.
+    """
+    get_tasks=lambda done: (utt for utt in corpus if utt.name not in done)
+    _run_extraction(savefile,get_tasks,compute_features,workers,window,flush_every)
+
+def prepare_features(list_file, path, savefile, win_len=0.025, win_shift=0.01, workers=None,
+        flush_every=100, window=None):
+    """ Streaming version of prepare_corp_dir followed by extract_features.
+
+        Each worker process reads the (memory-mapped) WAV file, aligns the labels and computes
+        the features of a single utterance at a time and at most window utterances are in 
+        flight, so the memory use doesn't depend on the size of the corpus. The arguments are
+        the same as in the two methods above.
+    """
+    with open(list_file) as f:
+        file_list=f.read().splitlines()
+
+    get_tasks=lambda done: ((f,path,win_len,win_shift) for f in file_list if f not in done)
+    _run_extraction(savefile,get_tasks,_prepare_features,workers,window,flush_every)
+
+def normalize(corp_file):
+    #stores the normalization statistics in the file instead of a normalized copy of the features
+    #Corpus(load_normalized=True) applies them while reading
+    compute_cmvn(corp_file)
 
 
 
@@ -333,10 +537,7 @@ def reduce183to61id(ids):
     return r183t61id[ids]
 
 def reduce183to61idseq(idseq):
-    ret=[]
-    for s in idseq:
-        ret.append(r183t61id[s])
-    return np.array(ret)
+    return r183t61id[np.asarray(idseq)]
 
 def reduce61to39(seq):
     ret=[]
@@ -344,7 +545,101 @@ def reduce61to39(seq):
         if s in r61t39:
             r=r61t39[s]
             if len(r)>0:
-                ret.add(r)
-    else:
-        ret.add(s)
-    return ret
\ No newline at end of file
+                ret.append(r)
+        else:
+            ret.append(s)
+    return ret
+
+#id of the phones removed by the reduction (q in the 61->39 mapping)
+deleted_id=-1
+
+class PhoneSet:
+    """ Phone inventories of the corpus together with the mappings between them.
+
+        Inventories:
+            183: states of the CNTK statelist (timit183)
+
+            61: the full TIMIT phoneme set (timit61)
+
+            39: the reduced set of Lee and Hon (timit39)
+
+            'phones': optionally, the list loaded from a file (eg. data/phones.list)
+
+        The mappings are stored as numpy arrays indexed by the source id, so whole label
+        sequences can be converted with a single fancy-index operation. Phones removed by
+        the mapping are given the deleted_id code.
+    """
+    def __init__(self,phones_list=None):
+
+        self.names={183:timit183,61:timit61,39:timit39}
+        if phones_list:
+            with open(phones_list) as f:
+                self.names['phones']=f.read().splitlines()
+
+        self.ids={}
+        for k,v in self.names.items():
+            self.ids[k]=dict(zip(v,range(len(v))))
+
+        self.maps={}
+        self.maps[(183,61)]=np.array([self.ids[61][s.split('_')[0]] for s in timit183])
+        self.maps[(61,39)]=np.array([self._reduce61to39(p) for p in timit61])
+        self.maps[(183,39)]=self.maps[(61,39)][self.maps[(183,61)]]
+
+        if 'phones' in self.names:
+            m=self.ids['phones']
+            self.maps[(39,'phones')]=np.array([m.get(p,deleted_id) for p in timit39])
+
+    def _reduce61to39(self,p):
+        r=r61t39.get(p,p)
+        if len(r)==0:
+            return deleted_id
+        return self.ids[39][r]
+
+    def size(self,inv):
+        return len(self.names[inv])
+
+    def index(self,names,inv=61):
+        m=self.ids[inv]
+        return np.array([m[n] for n in names],dtype=int)
+
+    def lookup(self,ids,inv=61):
+        return [self.names[inv][i] for i in ids]
+
+    def mapping(self,src,dst):
+        for inv in (src,dst):
+            if inv not in self.names:
+                raise ValueError('Unknown phone inventory: '+str(inv))
+        if src==dst:
+            return np.arange(self.size(src))
+        if (src,dst) in self.maps:
+            return self.maps[(src,dst)]
+        #compose the mappings through the 39 phone set
+        if (src,39) not in self.maps or (39,dst) not in self.maps:
+            raise ValueError('No mapping from {} to {} phones'.format(src,dst))
+        m=self.maps[(src,39)]
+        d=self.maps[(39,dst)]
+        ret=d[m]
+        ret[m==deleted_id]=deleted_id
+        return ret
+
+    def fold(self,labels,src=61,dst=39):
+        """ Maps the array of labels from one inventory to another. The removed phones are
+            marked with deleted_id.
+        """
+        return self.mapping(src,dst)[labels]
+
+    def fold_posteriors(self,post,src=61,dst=39):
+        """ Sums the columns of the posterior matrix (...xN) belonging to the same phone of the 
+            target inventory. The columns of the removed phones are dropped.
+        """
+        m=self.mapping(src,dst)
+        keep=np.flatnonzero(m!=deleted_id)
+        order=keep[np.argsort(m[keep],kind='mergesort')]
+        tgt=m[order]
+        starts=np.flatnonzero(np.concatenate(([True],tgt[1:]!=tgt[:-1])))
+
+        ret=np.zeros(post.shape[:-1]+(self.size(dst),),dtype=post.dtype)
+        ret[...,tgt[starts]]=np.add.reduceat(post[...,order],starts,axis=-1)
+        return ret
+
+phoneset=PhoneSet()
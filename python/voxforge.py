@@ -1,29 +1,270 @@
 import numpy as np
 import urllib
+import urlparse
+import httplib
+import socket
+import threading
+import Queue
+import time
+import json
+import hashlib
+import itertools
+import collections
+import array
+import copy
+from multiprocessing import Pool, cpu_count
 import lxml.html
 import os
 import tarfile
 import gzip
 import re
 import pickle
-import shutil
 import random
-from scikits.audiolab import Sndfile
+from scipy.io import wavfile
+from io import BytesIO
+import tempfile
+
+try:
+    import soundfile
+except (ImportError,OSError):
+    #OSError means libsndfile is missing
+    soundfile=None
+
+try:
+    from scikits.audiolab import Sndfile
+except ImportError:
+    Sndfile=None
 
 from tqdm import *
 
-def downloadVoxforgeData(path):
+from parallel import imap_window
+
+voxforge_url='http://www.repository.voxforge1.org/downloads/SpeechCorpus/Trunk/Audio/Main/16kHz_16bit/'
+
+def listVoxforgeFiles(url=voxforge_url):
+    """ Reads the list of sessions (tgz files) from the directory listing at the given URL.
+
+        Returns:
+            list: tuples with the name of the file and the text of its row in the listing (the 
+            date and size shown by the server), which is used to detect changes on the server
+    """
+    connection = urllib.urlopen(url)
+
+    dom =  lxml.html.fromstring(connection.read())
+
+    connection.close()
+
+    files=[]
+    for a in dom.xpath('//a[@href]'):
+        link=a.get('href')
+        if link.endswith('.tgz'):
+            row=a.getparent()
+            while row is not None and row.tag!='tr':
+                row=row.getparent()
+            if row is not None:
+                stamp=row.text_content()
+            else:
+                stamp=a.text_content()+(a.tail or '')
+            files.append((link,' '.join(stamp.split())))
+
+    return files
+
+def _md5(filename):
+    h=hashlib.md5()
+    with open(filename,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20),''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _loadManifest(path):
+    manifest_file=path+'/manifest.json'
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def _saveManifest(path,manifest):
+    manifest_file=path+'/manifest.json'
+    with open(manifest_file+'.tmp','w') as f:
+        json.dump(manifest,f,indent=1,sort_keys=True)
+    os.rename(manifest_file+'.tmp',manifest_file)
+
+class _Connection:
+    """ Persistent HTTP connection to the server, reopened after errors. """
+    def __init__(self,url):
+        u=urlparse.urlparse(url)
+        self.scheme=u.scheme
+        self.host=u.netloc
+        self.path=u.path
+        self.conn=None
+
+    def request(self,method,f,headers={}):
+        if self.conn is None:
+            if self.scheme=='https':
+                self.conn=httplib.HTTPSConnection(self.host,timeout=60)
+            else:
+                self.conn=httplib.HTTPConnection(self.host,timeout=60)
+        self.conn.request(method,self.path+f,headers=headers)
+        return self.conn.getresponse()
+
+    def reset(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn=None
+
+def _downloadFile(conn,f,dl,retries):
+    """ Downloads a single file into dl+'.part' (resuming from its current size using the HTTP
+        Range header) and renames it to dl when it's complete. Returns the number of bytes read
+        and the ETag and Last-Modified headers of the response.
+    """
+    part=dl+'.part'
+    read=0
+    for attempt in range(retries):
+        try:
+            have=0
+            headers={}
+            if os.path.exists(part):
+                have=os.stat(part).st_size
+                headers['Range']='bytes={}-'.format(have)
+
+            r=conn.request('GET',f,headers)
+
+            if r.status==416:
+                #the partial file is already complete (or broken)
+                r.read()
+                cr=r.getheader('Content-Range','')
+                if cr.startswith('bytes */') and int(cr[8:])==have:
+                    os.rename(part,dl)
+                    return read,r.getheader('ETag'),r.getheader('Last-Modified')
+                os.remove(part)
+                continue
+
+            if r.status==206:
+                mode='ab'
+            elif r.status==200:
+                mode='wb'
+            else:
+                r.read()
+                raise IOError('HTTP error {} for {}'.format(r.status,f))
+
+            length=r.getheader('Content-Length')
+            n=0
+            with open(part,mode) as fo:
+                while True:
+                    chunk=r.read(65536)
+                    if not chunk:
+                        break
+                    fo.write(chunk)
+                    n+=len(chunk)
+            read+=n
+
+            if length is not None and n<int(length):
+                raise IOError('Incomplete download of {}'.format(f))
+
+            os.rename(part,dl)
+            return read,r.getheader('ETag'),r.getheader('Last-Modified')
+
+        except (httplib.HTTPException,socket.error,IOError) as e:
+            conn.reset()
+            if attempt==retries-1:
+                raise
+
+    raise IOError('Failed to download {}'.format(f))
+
+def _downloadWorker(url,path,q,retries,stats,lock,progress,manifest):
+
+    conn=_Connection(url)
+
+    while True:
+        item=q.get()
+        if item is None:
+            break
+
+        f,stamp,entry=item
+        dl=path+'/'+f
+        res='downloaded'
+        n=0
+        try:
+            etag=None
+            lm=None
+            if os.path.exists(dl):
+                r=conn.request('HEAD',f)
+                r.read()
+                if r.status!=200:
+                    raise IOError('HTTP error {} for {}'.format(r.status,f))
+                u_s=int(r.getheader('Content-Length'))
+                etag=r.getheader('ETag')
+                lm=r.getheader('Last-Modified')
+                dl_s=os.stat(dl).st_size
+                if entry is not None and ((etag and etag!=entry['etag']) or 
+                                          (lm and lm!=entry['last_modified'])):
+                    #the file changed on the server
+                    os.remove(dl)
+                    if os.path.exists(dl+'.part'):
+                        os.remove(dl+'.part')
+                elif u_s == dl_s:
+                    res='skipped'
+                elif dl_s < u_s:
+                    #continue from what we have
+                    os.rename(dl,dl+'.part')
+                else:
+                    os.remove(dl)
+            if res=='downloaded':
+                n,etag,lm=_downloadFile(conn,f,dl,retries)
+
+            if res=='skipped' and entry is not None and entry['size']==os.stat(dl).st_size:
+                md5=entry['md5']
+            else:
+                md5=_md5(dl)
+
+            new_entry={'url':url+f,'size':os.stat(dl).st_size,'etag':etag,'last_modified':lm,
+                       'md5':md5,'listing':stamp}
+
+        except Exception as e:
+            conn.reset()
+            res='failed'
+            new_entry=None
+            print 'Error downloading {}: {}'.format(f,e)
+
+        with lock:
+            stats[res]+=1
+            stats['bytes']+=n
+            if new_entry is not None:
+                manifest[f]=new_entry
+                stats['since_save']+=1
+                if stats['since_save']>=100:
+                    _saveManifest(path,manifest)
+                    stats['since_save']=0
+            progress.update(1)
+
+def downloadVoxforgeData(path,url=voxforge_url,workers=4,retries=5,verify=False):
     """ Downloads the Voxforge speech database from the official website.
 
         Args:
             path(string): path to store the files
 
+            url(string): URL of the directory listing with the sessions
+
+            workers(int): number of files downloaded at the same time
+
+            retries(int): number of attempts for each file
+
+            verify(bool): recompute the checksums of the local files and compare them to the
+                ones in the manifest
+
         Returns: nothing
 
-        Note: this can take a long time and may require restarts. The method cehcks each 
-        downloaded file, compares its size with the one online and restarts the download
-        on incomplete files. You can run this method many times to make sure everything is
-        downloaded correctly.
+        Note: this can take a long time and may require restarts. Each worker keeps a single
+        (keep-alive) connection to the server. The files are downloaded into a '.part' file, 
+        which is renamed when it's complete. After an error, the download of the file is
+        resumed from where it stopped using the HTTP Range header. Existing files are compared
+        with the size of the ones online. You can run this method many times to make sure 
+        everything is downloaded correctly.
+
+        A manifest (manifest.json in the path) stores the URL, size, ETag, Last-Modified and MD5
+        of each downloaded file, together with its row in the directory listing. Files whose 
+        listing row and local size didn't change since the last run are skipped without 
+        contacting the server, so only the directory listing is read when nothing changed.
     """
     path=os.path.abspath(path)
     
@@ -32,57 +273,64 @@ def downloadVoxforgeData(path):
     if not os.path.exists(path):
         os.mkdir(path)
 
-    url='http://www.repository.voxforge1.org/downloads/SpeechCorpus/Trunk/Audio/Main/16kHz_16bit/'
+    files=listVoxforgeFiles(url)
+            
+    print 'Found '+str(len(files))+' files (sessions)...'
 
-    connection = urllib.urlopen(url)
+    manifest=_loadManifest(path)
 
-    dom =  lxml.html.fromstring(connection.read())
+    stats={'downloaded':0,'skipped':0,'failed':0,'unchanged':0,'bytes':0,'since_save':0}
 
-    files=[]
-    for link in dom.xpath('//a/@href'):
-        if link.endswith('.tgz'):
-            files.append(link)
-            
-    print 'Found '+str(len(files))+' files (sessions)...'
-    
-    skipped=0
-    dled=0
-    for f in tqdm(files):
+    q=Queue.Queue()
+    for f,stamp in files:
+        entry=manifest.get(f)
         dl=path+'/'+f
-        u=url+f
-
-        if not os.path.exists(dl):
-            dled+=1
-            while True:
-                try:
-                    urllib.urlretrieve(u,dl)
-                except urllib.ContentTooShortError as e:
-                    print e.strerror
-                    print 'Error downloading! Retrying...'
+        if entry is not None:
+            if entry['url']!=url+f:
+                entry=None
+            elif os.path.exists(dl) and os.stat(dl).st_size==entry['size'] and \
+                    entry['listing']==stamp:
+                if not verify or _md5(dl)==entry['md5']:
+                    stats['unchanged']+=1
                     continue
-                break
-        else:
+                print 'Checksum mismatch in {}, downloading again...'.format(f)
+                os.remove(dl)
+                entry=None
+        q.put((f,stamp,entry))
 
-            dl_s=os.stat(dl).st_size
-            u_p=urllib.urlopen(u)
-            u_s=int(u_p.info().getheaders('Content-Length')[0])
-            u_p.close()
+    lock=threading.Lock()
+    progress=tqdm(total=q.qsize())
 
-            if u_s != dl_s:
-                while True:
-                    try:
-                        urllib.urlretrieve(u,dl)
-                    except urllib.ContentTooShortError as e:
-                        print e.strerror
-                        print 'Error downloading! Retrying...'
-                        continue
-                    break
-                dled+=1
-            else:
-                skipped+=1
+    start=time.time()
+
+    threads=[]
+    for i in range(workers):
+        q.put(None)
+        t=threading.Thread(target=_downloadWorker,
+                           args=(url,path,q,retries,stats,lock,progress,manifest))
+        t.daemon=True
+        t.start()
+        threads.append(t)
+
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+    finally:
+        with lock:
+            _saveManifest(path,manifest)
+
+    progress.close()
+
+    elapsed=time.time()-start
                 
-    print 'Downloaded '+str(dled)+' files...'
-    print 'Skipped (already existing) '+str(skipped)+' files...'
+    print 'Unchanged since the last run '+str(stats['unchanged'])+' files...'
+    print 'Downloaded '+str(stats['downloaded'])+' files...'
+    print 'Skipped (already existing) '+str(stats['skipped'])+' files...'
+    if stats['failed']>0:
+        print 'Failed '+str(stats['failed'])+' files (run again to retry)...'
+    print 'Read {:.1f} MB in {:.1f}s ({:.2f} MB/s)'.format(stats['bytes']/1e6,elapsed,
+        stats['bytes']/1e6/max(elapsed,1e-6))
 
 
 class CorpusSession:
@@ -99,14 +347,63 @@ class CorpusSession:
             data(dictonary): list of audio recordings of the same utterances as above saved
                 as file(string)->audio(numpy array) dictionary
 
-        Note: due to files being saved in more than one format (WAV and FLAC), scikits.audiolab
-        is used to load the data. Samples are stored as numpy.int16 datatype.
+        Note: files are saved in more than one format (WAV and FLAC) and are decoded in memory
+        by decodeAudio: WAV using scipy and FLAC using soundfile, with scikits.audiolab only as
+        a fallback. Samples are stored as numpy.int16 datatype.
     """
     def __init__(self):
         self.props={}
         self.prompts={}
         self.data={}
 
+def _toInt16(data):
+    if data.dtype==np.int16:
+        return data
+    if data.dtype==np.uint8:
+        return ((data.astype(np.int16)-128)<<8)
+    if data.dtype==np.int32:
+        return (data>>16).astype(np.int16)
+    return np.clip(data*32768,-32768,32767).astype(np.int16)
+
+def decodeAudio(buf, ext):
+    """ Decodes an audio file held in memory.
+
+        Args:
+            buf(string): contents of the file
+
+            ext(string): type of the file ('wav' or 'flac')
+
+        Returns:
+            numpy array: audio signal (int16)
+
+        Note: WAV files are read with scipy and FLAC files with the soundfile module (if it's
+        installed), so no temporary files are used. Otherwise (and for files scipy can't read) the
+        data is written to a unique temporary file and read using scikits.audiolab.
+    """
+    ext=ext.lstrip('.').lower()
+
+    try:
+        if ext=='wav':
+            fs,data=wavfile.read(BytesIO(buf))
+            return _toInt16(data)
+        if ext=='flac' and soundfile is not None:
+            data,fs=soundfile.read(BytesIO(buf),dtype='int16')
+            return data
+    except Exception:
+        if Sndfile is None:
+            raise
+
+    if Sndfile is None:
+        raise ImportError('Decoding {} files requires soundfile or scikits.audiolab'.format(ext))
+
+    with tempfile.NamedTemporaryFile(suffix='.'+ext) as tmp:
+        tmp.write(buf)
+        tmp.flush()
+        sf=Sndfile(tmp.name)
+        data=sf.read_frames(sf.nframes,dtype=np.int16)
+        sf.close()
+    return data
+
 def loadFile(path):
     """ Loads a single session from a TGZ archive.
 
@@ -154,21 +451,74 @@ def loadFile(path):
         except KeyError:
             continue
 
-        shutil.copyfileobj(ft,open('temp','wb'))
-        sf=Sndfile('temp')
-        data[f]=sf.read_frames(sf.nframes,dtype=np.int16)
+        data[f]=decodeAudio(ft.read(),type)
         
     ret=CorpusSession()
     ret.props=props
     ret.prompts=prompts
     ret.data=data
-    
-    os.remove('temp')
 
     tf.close()
 
     return ret
 
+def _loadIndex(archive):
+    idx_file=archive+'.idx'
+    if not os.path.exists(idx_file):
+        return None
+    st=os.stat(archive)
+    with open(idx_file) as f:
+        idx=json.load(f)
+    if idx['size']!=st.st_size or idx['mtime']!=st.st_mtime:
+        return None
+    return idx['members']
+
+def _saveIndex(archive,members):
+    st=os.stat(archive)
+    idx_file=archive+'.idx'
+    try:
+        with open(idx_file+'.tmp','w') as f:
+            json.dump({'size':st.st_size,'mtime':st.st_mtime,'members':members},f)
+        os.rename(idx_file+'.tmp',idx_file)
+    except (IOError,OSError):
+        #read-only location - the index will simply be built again next time
+        pass
+
+def archiveIndex(archive):
+    """ Returns the index of the members of an archive.
+
+        Args:
+            archive(string): path to the archive (tgz)
+
+        Returns:
+            dictionary: mapping the name of each member to a 2-element list with the offset of
+            its data in the uncompressed stream and its size
+
+        Note: the index is stored next to the archive (with an .idx extension) and is rebuilt
+        only if the size or modification time of the archive changes.
+    """
+    members=_loadIndex(archive)
+    if members is not None:
+        return members
+
+    members={}
+    tf=tarfile.open(archive,'r|gz')
+    for ti in tf:
+        members[ti.name]=[ti.offset_data,ti.size]
+    tf.close()
+
+    _saveIndex(archive,members)
+
+    return members
+
+def _findAudio(names,audioname):
+    for ext in ('wav','flac'):
+        suffix='/'+audioname+'.'+ext
+        for n in names:
+            if n.endswith(suffix):
+                return n,ext
+    return None,None
+
 def loadAudio(archive, audioname):
     """ Reads an audio file from within the archive.
 
@@ -179,36 +529,75 @@ def loadAudio(archive, audioname):
 
         Returns:
             numpy array: loaded audio signal or empty array if file not found
+
+        Note: uses the member index (see archiveIndex) to decompress the archive only up to the
+        end of the requested file.
     """
-    tf=tarfile.open(archive)
-    
-    n=tf.getnames()    
+    members=archiveIndex(archive)
 
-    ext='.flac'
-    if any(item.endswith('/wav') for item in n):
-        ext='.wav'
-        
-    p=filter(lambda x : x.endswith(audioname+ext),n)
+    name,ext=_findAudio(members,audioname)
 
-    if len(p)==0:
+    if name is None:
         return np.array([])
 
-    try:
-        ft=tf.extractfile(p[0])
-    except KeyError:
-        return np.array([])
+    offset,size=members[name]
 
-    shutil.copyfileobj(ft,open('temp','wb'))
-    sf=Sndfile('temp')
-    data=sf.read_frames(sf.nframes,dtype=np.int16)
-        
-    os.remove('temp')
+    with gzip.open(archive) as f:
+        f.seek(offset)
+        buf=f.read(size)
+
+    return decodeAudio(buf,ext)
+
+def loadArchiveAudio(archive, audionames):
+    """ Reads many audio files from the archive in a single pass.
+
+        Args:
+            archive(string): path to the archive (tgz)
+
+            audionames(list): names of the files (without extension)
+
+        Returns:
+            dictionary: mapping the names to the loaded audio signals (missing files are omitted)
 
+        Note: the archive is decompressed once, as a stream. The member index of the archive 
+        is saved along the way, if it doesn't exist yet.
+    """
+    wanted=set(audionames)
+    ret={}
+
+    members=_loadIndex(archive)
+    save_index=members is None
+    if save_index:
+        members={}
+
+    tf=tarfile.open(archive,'r|gz')
+    for ti in tf:
+        if save_index:
+            members[ti.name]=[ti.offset_data,ti.size]
+        if not ti.isfile():
+            continue
+        base,ext=os.path.splitext(ti.name.split('/')[-1])
+        ext=ext[1:].lower()
+        if base in wanted and ext in ('wav','flac'):
+            if base in ret and ext=='flac':
+                continue
+            ret[base]=decodeAudio(tf.extractfile(ti).read(),ext)
+            if not save_index and len(ret)==len(wanted):
+                break
     tf.close()
 
-    return data
+    if save_index:
+        _saveIndex(archive,members)
+
+    return ret
+
+def _loadSession(filename):
+    try:
+        return loadFile(filename)
+    except IOError:
+        return None
 
-def loadBySpeaker(path, limit=None):
+def loadBySpeaker(path, limit=None, workers=1, max_inflight=None):
     """ Load a directory containing the Voxforge database and organize by speaker.
 
         Args:
@@ -216,25 +605,45 @@ def loadBySpeaker(path, limit=None):
 
             limit(int): limit the number of loaded files to a given amount (in the suffled list).
                 This is useful for demonstration purposes. If None (default) than it is completely
-                ignored and files are read in order.
+                ignored and files are read in sorted order.
+
+            workers(int): number of processes loading the sessions (None means all the cores)
+
+            max_inflight(int): maximum number of sessions loaded by the workers, but not yet added
+                to the corpus - limits the memory used (default is 2 per worker)
 
         Returns:
             dictionary: mapping speaker(string) to a dictionary of utterances(string) mapped
             to a 2-element list with the data(numpy array) and prompts(list of strings)
+
+        Note: the sessions are added in the order of the file list, so the result (including
+        the numbering of the anonymous speakers) doesn't depend on the number of workers.
     """
     anon_count=0
     corp={}
-    file_list=os.listdir(path)
+    #sorted, so the anonymous speakers are numbered the same way on any filesystem
+    file_list=sorted(os.listdir(path))
     if limit:
         random.shuffle(file_list)
         if limit<len(file_list):
             file_list=file_list[:limit]
 
-    for f in tqdm(file_list):
-        if f.endswith('.tgz'):
-            try:
-                cf=loadFile(path+'/'+f)
-            except IOError:
+    file_list=[path+'/'+f for f in file_list if f.endswith('.tgz')]
+
+    if workers==1:
+        pool=None
+        sessions=itertools.imap(_loadSession,file_list)
+    else:
+        if workers is None:
+            workers=cpu_count()
+        if max_inflight is None:
+            max_inflight=2*workers
+        pool=Pool(workers)
+        sessions=imap_window(pool,_loadSession,file_list,max_inflight)
+
+    try:
+        for cf in tqdm(sessions,total=len(file_list)):
+            if cf is None:
                 continue
             
             if 'User Name' in cf.props:
@@ -252,8 +661,155 @@ def loadBySpeaker(path, limit=None):
             for p in cf.data:
                 d[p]=[cf.data[p],cf.prompts[p]]
             corp[spk]=d
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
     return corp
 
+def _saveArrays(path,**arrays):
+    """ Stores numpy arrays in a folder (one .npy file per array) so they can be memory-mapped. """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for name,arr in arrays.iteritems():
+        np.save(path+'/'+name+'.npy',arr)
+
+def _loadArrays(path,mmap=True):
+    """ Loads the arrays saved by _saveArrays into a dictionary. """
+    ret={}
+    for f in os.listdir(path):
+        if f.endswith('.npy'):
+            ret[f[:-4]]=np.load(path+'/'+f,mmap_mode='r' if mmap else None)
+    return ret
+
+def packAudio(path,out):
+    """ Converts the Voxforge database into a single file with raw audio samples.
+
+        Args:
+            path(string): path to the folder containing the Voxforge databse (tgz files)
+
+            out(string): path to the output folder
+
+        Returns: 
+            int: number of utterances stored
+
+        Output format:
+            audio.pcm: samples (int16) of all the utterances one after another
+            
+            index: arrays (.npy) with the speaker, session (archive name), prompt (audio file name),
+            text, offset and length (in samples) of each utterance
+
+        The speakers are named the same way as in loadBySpeaker (anonymous sessions are numbered
+        in the order of the archives). Use AudioStore to read the data.
+    """
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    spk=[]
+    session=[]
+    prompt=[]
+    text=[]
+    offset=[]
+    length=[]
+
+    anon_count=0
+    pos=0
+    with open(out+'/audio.pcm','wb') as fo:
+        for f in tqdm(sorted(os.listdir(path))):
+            if not f.endswith('.tgz'):
+                continue
+            try:
+                cf=loadFile(path+'/'+f)
+            except IOError:
+                continue
+
+            s=cf.props.get('User Name','anonymous')
+            if s == 'anonymous':
+                anon_count+=1
+                s += '_'+str(anon_count)
+
+            for p in sorted(cf.data):
+                data=cf.data[p]
+                if data.ndim>1:
+                    data=data[:,0]
+                data=np.ascontiguousarray(data,dtype=np.int16)
+                data.tofile(fo)
+
+                spk.append(s)
+                session.append(f[:-4])
+                prompt.append(p)
+                text.append(' '.join(cf.prompts[p]))
+                offset.append(pos)
+                length.append(data.size)
+                pos+=data.size
+
+    _saveArrays(out+'/index',spk=np.array(spk,dtype=str),session=np.array(session,dtype=str),
+                prompt=np.array(prompt,dtype=str),text=np.array(text,dtype=str),
+                offset=np.array(offset,dtype=np.int64),length=np.array(length,dtype=np.int64))
+
+    return len(spk)
+
+class AudioStore:
+    """ Reads the audio stored by packAudio. The samples are memory-mapped, so each utterance is 
+        a (read-only) view of the file and nothing is loaded until it's used.
+
+        Properties:
+            spk, session, prompt, text(numpy arrays): description of each utterance
+
+            offset, length(numpy arrays): position of each utterance in the file (in samples)
+
+        Example:
+            store=AudioStore('voxforge_packed')
+            for i in range(len(store)):
+                audio=store[i]
+    """
+    def __init__(self,path):
+        idx=_loadArrays(path+'/index')
+        self.spk=idx['spk']
+        self.session=idx['session']
+        self.prompt=idx['prompt']
+        self.text=idx['text']
+        self.offset=idx['offset']
+        self.length=idx['length']
+        if os.stat(path+'/audio.pcm').st_size>0:
+            self.samples=np.memmap(path+'/audio.pcm',dtype=np.int16,mode='r')
+        else:
+            self.samples=np.zeros(0,dtype=np.int16)
+        self.utt_map=None
+
+    def __len__(self):
+        return self.offset.size
+
+    def __getitem__(self,i):
+        o=self.offset[i]
+        return self.samples[o:o+self.length[i]]
+
+    def find(self,session,prompt):
+        """ Returns the number of the utterance with the given session and prompt (or -1). """
+        if self.utt_map is None:
+            self.utt_map={(s,p):i for i,(s,p) in enumerate(zip(self.session,self.prompt))}
+        return self.utt_map.get((session,prompt),-1)
+
+    def get(self,session,prompt):
+        """ Returns the audio of the utterance with the given session and prompt (or an empty
+            array if it doesn't exist).
+        """
+        i=self.find(session,prompt)
+        if i<0:
+            return np.array([],dtype=np.int16)
+        return self[i]
+
+    def getSpeakers(self):
+        return np.unique(self.spk)
+
+    def bySpeaker(self):
+        """ Returns the corpus in the same format as loadBySpeaker (with views of the data). """
+        corp={}
+        for i in range(len(self)):
+            corp.setdefault(self.spk[i],{})[self.prompt[i]]=[self[i],self.text[i].split()]
+        return corp
+
 def loadLex(path):
     """ Loads a lexicon from a file.
 
@@ -267,6 +823,14 @@ def loadLex(path):
         a number in the file. This method doesn't check if the same word exists twice in the
         lexicon and will overwrite the same word each time (leaving the last transctiption only).
     """
+    lex={}
+    for word,pron in _readLex(path):
+        lex[word]=pron
+
+    return lex
+
+def _readLex(path):
+    """ Yields the (word,pronunciation) pairs from the lexicon archive (downloading it if needed). """
     path=os.path.abspath(path)
 
     if not os.path.exists(path):
@@ -277,14 +841,160 @@ def loadLex(path):
 
     f=tf.extractfile('VoxForge/VoxForgeDict')
 
-    lex={}
     for l in f:
         t=re.split('\[[^\]]*\]',l)
-        lex[t[0].strip()]=t[1].strip().split(' ')
+        if len(t)<2:
+            continue
+        yield t[0].strip(),t[1].strip().split(' ')
         
     tf.close()
 
-    return lex
+default_phones=os.path.join(os.path.dirname(os.path.abspath(__file__)),'../data/phones.list')
+
+def compileLex(path,out=None,phones=default_phones):
+    """ Converts the lexicon into a set of arrays that can be memory-mapped (see Lexicon).
+
+        Args:
+            path(string): path to the lexicon (downloaded if it doesn't exist)
+
+            out(string): output folder (default is path+'.lex')
+
+            phones(string): file with the list of phonemes used to convert them into ids
+
+        Returns:
+            string: path to the compiled lexicon
+
+        Unlike loadLex, all the pronunciations of each word are kept. Variants like WORD(2) are 
+        stored under WORD in the order they appear in the file. Phonemes are matched to the list
+        regardless of case and the ones missing from the list are added at its end.
+    """
+    if out is None:
+        out=os.path.abspath(path)+'.lex'
+
+    phone_names=[]
+    with open(phones) as f:
+        for l in f:
+            phone_names.append(l.strip())
+    ph_map={ph:i for i,ph in enumerate(phone_names)}
+
+    prons={}
+    for word,pron in _readLex(path):
+        word=re.sub('\(\d+\)$','',word)
+        ids=[]
+        for ph in pron:
+            ph=ph.lower()
+            if not ph in ph_map:
+                print 'Adding phoneme missing from the list: '+ph
+                ph_map[ph]=len(phone_names)
+                phone_names.append(ph)
+            ids.append(ph_map[ph])
+        prons.setdefault(word,[]).append(ids)
+
+    words=sorted(prons)
+    word_var=[0]
+    var_ph=[0]
+    ph=[]
+    for w in words:
+        for pron in prons[w]:
+            ph.extend(pron)
+            var_ph.append(len(ph))
+        word_var.append(len(var_ph)-1)
+
+    _saveArrays(out,words=np.array(words,dtype=str),word_var=np.array(word_var,dtype=np.int64),
+                var_ph=np.array(var_ph,dtype=np.int64),phones=np.array(ph,dtype=np.int16),
+                phone_names=np.array(phone_names,dtype=str))
+
+    return out
+
+class Lexicon:
+    """ Compiled lexicon (see compileLex).
+
+        Properties:
+            words(numpy array): sorted list of words
+
+            word_var(numpy array): offsets of the pronunciations of each word (the pronunciations
+                of word i are word_var[i] to word_var[i+1]-1)
+
+            var_ph(numpy array): offsets of the phonemes of each pronunciation
+
+            phones(numpy array): ids of the phonemes of all the pronunciations
+
+            phone_names(numpy array): names of the phonemes (indexed by id)
+
+        Example:
+            lex=Lexicon('../data/lex.tgz')
+            ph,offsets=lex.expand(prompts)
+            #phonemes of prompt i:
+            ph[offsets[i]:offsets[i+1]]
+    """
+    def __init__(self,path,phones=default_phones):
+        path=os.path.abspath(path)
+        if os.path.isdir(path):
+            out=path
+        else:
+            out=path+'.lex'
+            if not os.path.exists(out+'/words.npy') or \
+                    (os.path.exists(path) and os.stat(path).st_mtime>os.stat(out+'/words.npy').st_mtime):
+                compileLex(path,out,phones)
+
+        arr=_loadArrays(out)
+        self.words=arr['words']
+        self.word_var=arr['word_var']
+        self.var_ph=arr['var_ph']
+        self.phones=arr['phones']
+        self.phone_names=arr['phone_names']
+
+    def __len__(self):
+        return self.words.size
+
+    def index(self,words):
+        """ Returns the indices of the words in the lexicon (-1 for the missing words). """
+        words=np.asarray(words,dtype=str)
+        if words.size==0:
+            return np.zeros(0,dtype=np.int64)
+        i=np.searchsorted(self.words,words)
+        i[i==self.words.size]=0
+        i[self.words[i]!=words]=-1
+        return i
+
+    def lookup(self,word):
+        """ Returns the list of all the pronunciations (arrays of phoneme ids) of a word. """
+        i=self.index([word])[0]
+        if i<0:
+            raise KeyError(word)
+        return [self.phones[self.var_ph[v]:self.var_ph[v+1]] 
+                for v in range(self.word_var[i],self.word_var[i+1])]
+
+    def expand(self,prompts,variant=0):
+        """ Converts a list of prompts into phonemes.
+
+            Args:
+                prompts(list): list of prompts (each is a list of words)
+
+                variant(int): which pronunciation to use (the last one is used for words with
+                    fewer pronunciations)
+
+            Returns:
+                tuple: array of phoneme ids of all the prompts and the array of offsets of each
+                prompt in it (of size len(prompts)+1)
+        """
+        lens=np.array([len(p) for p in prompts],dtype=np.int64)
+        w=self.index(list(itertools.chain.from_iterable(prompts)))
+        if np.any(w<0):
+            raise KeyError(' '.join(np.asarray(list(itertools.chain.from_iterable(prompts)))[w<0]))
+
+        v=np.minimum(self.word_var[w]+variant,self.word_var[w+1]-1)
+        beg=self.var_ph[v]
+        ph_lens=self.var_ph[v+1]-beg
+
+        cum=np.concatenate(([0],np.cumsum(ph_lens)))
+        idx=np.arange(cum[-1])+np.repeat(beg-cum[:-1],ph_lens)
+
+        offsets=cum[np.concatenate(([0],np.cumsum(lens)))]
+
+        return self.phones[idx],offsets
+
+_lex_cache={}
 
 def addPhonemesSpk(corp,lex_path):
     """ Adds phonemes to the speaker corpus. It modifies the corp object in-place to add
@@ -296,17 +1006,25 @@ def addPhonemesSpk(corp,lex_path):
             lex_path(string): path to the lexicon file
 
         Returns: nothing
+
+        Note: uses the compiled lexicon (see Lexicon), which is built only the first time. The 
+        first pronunciation of each word is used and the phonemes are named as in phones.list.
     """
-    lex=loadLex(lex_path)
-    for spk in corp.keys():
-        for utt in corp[spk].keys():
-            ph=[]
-            for word in corp[spk][utt][1]:
-                ph.extend(lex[word])
-            if len(corp[spk][utt])==2:
-                corp[spk][utt].append(ph)
-            else:
-                corp[spk][utt][2]=ph
+    lex_path=os.path.abspath(lex_path)
+    if not lex_path in _lex_cache:
+        _lex_cache[lex_path]=Lexicon(lex_path)
+    lex=_lex_cache[lex_path]
+
+    utts=[(spk,utt) for spk in corp.keys() for utt in corp[spk].keys()]
+    ph,offsets=lex.expand([corp[spk][utt][1] for spk,utt in utts])
+    names=lex.phone_names[ph].tolist()
+
+    for i,(spk,utt) in enumerate(utts):
+        ph=names[offsets[i]:offsets[i+1]]
+        if len(corp[spk][utt])==2:
+            corp[spk][utt].append(ph)
+        else:
+            corp[spk][utt][2]=ph
 
 class AliUtt:
     """ Class describing the aligned utterance.
@@ -333,8 +1051,8 @@ class AliUtt:
         self.data=None
 
 def convertCTMToAli(ali_path,phones,audio,out):
-    """ Method used to convert a CTM file generated by Kaldi into a gzipped pickle file, that
-        is easier to parse in Python.
+    """ Method used to convert a CTM file generated by Kaldi into a format that is easier to 
+        parse in Python.
 
         Args:
             ali_path(string): path to the gzipped CTM file generated by Kaldi
@@ -343,12 +1061,19 @@ def convertCTMToAli(ali_path,phones,audio,out):
 
             audio(string): path to the Voxforge database sessions (tgz files)
 
-            out(string): path of the output PKLZ file
+            out(string): path of the output - if it ends with .pklz, the old gzipped pickle is
+                written, otherwise it is a folder with the arrays read by AliCorpus
 
         Returns: nothing
 
         Output file format:
-            list: a list of AliUtt objects (without the data)
+            pklz: a list of AliUtt objects (without the data)
+
+            folder: phones (int16) and ph_lens (int32) of all the utterances one after another,
+            offsets of the utterances in them (int64), audiofile of each utterance and the 
+            indices into the spk_names and archive_names tables
+
+        The CTM is processed as a stream, so the memory used is only that of the output arrays.
     """
     ph_map={}
     ph_count=0
@@ -357,9 +1082,18 @@ def convertCTMToAli(ali_path,phones,audio,out):
             ph_map[l[:-1]]=ph_count
             ph_count+=1
 
-    ali=[]
+    archives=set(f[:-4] for f in os.listdir(audio) if f.endswith('.tgz'))
+
+    ph_arr=array.array('h')
+    len_arr=array.array('i')
+    offsets=array.array('l',[0])
+    audiofiles=[]
+    spk_idx=array.array('i')
+    arch_idx=array.array('i')
+    spk_names={}
+    archive_names={}
+
     last_utt=''
-    utt=None
 
     print 'Reading...'
     with gzip.open(ali_path) as f:
@@ -371,28 +1105,28 @@ def convertCTMToAli(ali_path,phones,audio,out):
             
             if last_utt != fname:
                 
-                if utt:
-                    ali.append(utt)
-                    
-                utt=AliUtt()
+                if last_utt:
+                    offsets.append(len(ph_arr))
                 
                 tt=fname.split('-')
                 
-                utt.spk=tt[0]
+                spk=tt[0]
                 
                 if tt[0][:9] == 'anonymous':
                     tt[0]='anonymous'
                     
-                utt.archive='-'.join(tt[0:3])
-                utt.audiofile='-'.join(tt[3:])
+                archive='-'.join(tt[0:3])
+                audiofile='-'.join(tt[3:])
                 
-                archive_missing=lambda x: not os.path.exists(audio+'/'+x+'.tgz')
-                
-                if archive_missing(utt.archive):
-                    utt.archive='-'.join(tt[0:2])                    
-                    utt.audiofile='-'.join(tt[2:])
-                    if archive_missing(utt.archive):                        
-                        raise IOError(utt.archive)
+                if not archive in archives:
+                    archive='-'.join(tt[0:2])                    
+                    audiofile='-'.join(tt[2:])
+                    if not archive in archives:                        
+                        raise IOError(archive)
+
+                spk_idx.append(spk_names.setdefault(spk,len(spk_names)))
+                arch_idx.append(archive_names.setdefault(archive,len(archive_names)))
+                audiofiles.append(audiofile)
                 
                 last_utt=fname
             
@@ -403,36 +1137,225 @@ def convertCTMToAli(ali_path,phones,audio,out):
             
             assert(ph in ph_map)
             
-            utt.phones.append(ph_map[ph])
-            utt.ph_lens.append(int(float(t[3])*1000))
+            ph_arr.append(ph_map[ph])
+            len_arr.append(int(float(t[3])*1000))
     
-    if utt:
-        ali.append(utt)
+    if last_utt:
+        offsets.append(len(ph_arr))
 
     print 'Writing...'
-    with gzip.open(out,'wb') as f:
-        pickle.dump(ali,f,pickle.HIGHEST_PROTOCOL)
+    if out.endswith('.pklz'):
+        ali=AliCorpus(arrays=_aliArrays(ph_arr,len_arr,offsets,audiofiles,spk_idx,spk_names,
+                                        arch_idx,archive_names))
+        with gzip.open(out,'wb') as f:
+            utts=[]
+            for utt in ali:
+                utt.phones=utt.phones.tolist()
+                utt.ph_lens=utt.ph_lens.tolist()
+                utt.archive=str(utt.archive)
+                utt.audiofile=str(utt.audiofile)
+                utt.spk=str(utt.spk)
+                utts.append(utt)
+            pickle.dump(utts,f,pickle.HIGHEST_PROTOCOL)
+    else:
+        _saveArrays(out,**_aliArrays(ph_arr,len_arr,offsets,audiofiles,spk_idx,spk_names,
+                                     arch_idx,archive_names))
         
     print 'Done'
 
+def _aliArrays(ph_arr,len_arr,offsets,audiofiles,spk_idx,spk_names,arch_idx,archive_names):
+    table=lambda d: np.array(sorted(d,key=d.get),dtype=str)
+    return {'phones':np.frombuffer(ph_arr,dtype=np.int16),
+            'ph_lens':np.frombuffer(len_arr,dtype=np.int32),
+            'offsets':np.array(offsets,dtype=np.int64),
+            'audiofile':np.array(audiofiles,dtype=str),
+            'spk':np.frombuffer(spk_idx,dtype=np.int32),
+            'spk_names':table(spk_names),
+            'archive':np.frombuffer(arch_idx,dtype=np.int32),
+            'archive_names':table(archive_names)}
+
+class AliCorpus:
+    """ Aligned corpus stored in arrays (as written by convertCTMToAli). The arrays are 
+        memory-mapped and utterances are created only when accessed.
+
+        Properties:
+            phones, ph_lens(numpy arrays): phonemes and their lengths (in ms) of all utterances
+
+            offsets(numpy array): the phonemes of utterance i are offsets[i] to offsets[i+1]-1
+
+            audiofile(numpy array): name of the audio file of each utterance
+
+            spk, archive(numpy arrays): indices into the spk_names and archive_names tables
+
+        Example:
+            ali=AliCorpus('../data/ali')
+            utt=ali[100]
+            print utt.spk, utt.phones
+    """
+    def __init__(self,path=None,arrays=None):
+        if arrays is None:
+            arrays=_loadArrays(path)
+        self.phones=arrays['phones']
+        self.ph_lens=arrays['ph_lens']
+        self.offsets=arrays['offsets']
+        self.audiofile=arrays['audiofile']
+        self.spk=arrays['spk']
+        self.spk_names=arrays['spk_names']
+        self.archive=arrays['archive']
+        self.archive_names=arrays['archive_names']
+
+    def __len__(self):
+        return self.audiofile.size
+
+    def __getitem__(self,i):
+        if i<0:
+            i+=len(self)
+        if i<0 or i>=len(self):
+            raise IndexError(i)
+        utt=AliUtt()
+        b=self.offsets[i]
+        e=self.offsets[i+1]
+        utt.phones=self.phones[b:e]
+        utt.ph_lens=self.ph_lens[b:e]
+        utt.archive=self.archive_names[self.archive[i]]
+        utt.audiofile=self.audiofile[i]
+        utt.spk=self.spk_names[self.spk[i]]
+        return utt
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def loadAli(ali_file):
+    """ Loads the alignment written by convertCTMToAli.
+
+        Args:
+            ali_file(string): path to the PKLZ file or to the folder with the arrays
+
+        Returns:
+            list or AliCorpus: the aligned utterances (without the data)
+    """
+    if os.path.isdir(ali_file):
+        return AliCorpus(ali_file)
+    with gzip.open(ali_file) as f:    
+        return pickle.load(f)   
 
 def loadAlignedCorpus(ali_file,audio_path):
     """ Loads the data into a pickled aligned corpus.
 
         Args:
-            ali_file(string): path to the PKLZ corpus as prepared by the convertCTMToAli method
+            ali_file(string): path to the corpus (PKLZ file or folder) as prepared by the 
+                convertCTMToAli method
 
             audio_path(string): path to the folder containing the Voxforge session (tgz files)
 
         Returns:
             list: updated list of aligend utterances stored as AliUtt objects (with data loaded)
+
+        Note: the utterances are grouped by archive, so each archive is decompressed only once.
     """
-    with gzip.open(ali_file) as f:    
-        ali=pickle.load(f)   
-            
-    for utt in tqdm(ali):
-        data=loadAudio(audio_path+'/'+utt.archive+'.tgz',utt.audiofile)
-        assert data.size > 0
-        utt.data=data
+    ali=list(loadAli(ali_file))
+
+    by_archive={}
+    for utt in ali:
+        by_archive.setdefault(utt.archive,[]).append(utt)
+
+    for archive in tqdm(sorted(by_archive)):
+        utts=by_archive[archive]
+        data=loadArchiveAudio(audio_path+'/'+archive+'.tgz',[utt.audiofile for utt in utts])
+        for utt in utts:
+            assert utt.audiofile in data
+            utt.data=data[utt.audiofile]
             
-    return ali
\ No newline at end of file
+    return ali
+
+class AlignedDataset:
+    """ Lazy version of loadAlignedCorpus. The audio is loaded only when an utterance is accessed.
+        All the utterances from the same archive are decoded at once (in a single pass) and kept
+        in an LRU cache limited by size.
+
+        Args:
+            ali_file(string): path to the corpus (PKLZ file or folder) as prepared by the 
+                convertCTMToAli method
+
+            audio_path(string): path to the folder containing the Voxforge session (tgz files)
+
+            cache_size(int): maximum size (in bytes) of the decoded audio kept in memory
+
+        Example:
+            ds=AlignedDataset('../data/ali','../audio')
+            for utt in ds:
+                #utt is an AliUtt with data loaded
+                ...
+    """
+    def __init__(self,ali_file,audio_path,cache_size=256*1024*1024):
+        self.ali=loadAli(ali_file)
+        self.audio_path=audio_path
+        self.cache_size=cache_size
+        self.cache=collections.OrderedDict()
+        self.cached_bytes=0
+
+        if isinstance(self.ali,AliCorpus):
+            arch=np.asarray(self.ali.archive)
+            self.archive_names=self.ali.archive_names
+        else:
+            names={}
+            arch=np.array([names.setdefault(utt.archive,len(names)) for utt in self.ali],
+                          dtype=np.int64)
+            self.archive_names=np.array(sorted(names,key=names.get),dtype=str)
+        self.utt_archive=arch
+
+        #utterances of archive a are by_archive[arch_off[a]:arch_off[a+1]]
+        self.by_archive=np.argsort(arch,kind='mergesort')
+        self.arch_off=np.searchsorted(arch[self.by_archive],np.arange(self.archive_names.size+1))
+
+    def __len__(self):
+        return len(self.ali)
+
+    def _session(self,a):
+        if a in self.cache:
+            self.cache[a]=self.cache.pop(a)
+            return self.cache[a]
+
+        utts=self.by_archive[self.arch_off[a]:self.arch_off[a+1]]
+        archive=self.audio_path+'/'+self.archive_names[a]+'.tgz'
+        data=loadArchiveAudio(archive,[self.ali[i].audiofile for i in utts])
+
+        size=sum(d.nbytes for d in data.itervalues())
+        while self.cache and self.cached_bytes+size>self.cache_size:
+            k,v=self.cache.popitem(last=False)
+            self.cached_bytes-=sum(d.nbytes for d in v.itervalues())
+        self.cache[a]=data
+        self.cached_bytes+=size
+
+        return data
+
+    def __getitem__(self,i):
+        utt=copy.copy(self.ali[i])
+        data=self._session(self.utt_archive[i])
+        assert utt.audiofile in data
+        utt.data=data[utt.audiofile]
+        return utt
+
+    def iterate(self,shuffle=False,seed=None):
+        """ Iterates over the utterances, grouped by archive (so each archive is read once).
+
+            Args:
+                shuffle(bool): randomize the order of the archives and of the utterances inside
+                    each archive
+
+                seed(int): seed of the random generator used for shuffling
+        """
+        order=np.arange(self.archive_names.size)
+        rng=np.random.RandomState(seed)
+        if shuffle:
+            rng.shuffle(order)
+        for a in order:
+            utts=self.by_archive[self.arch_off[a]:self.arch_off[a+1]].copy()
+            if shuffle:
+                rng.shuffle(utts)
+            for i in utts:
+                yield self[i]
+
+    def __iter__(self):
+        return self.iterate()